@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import os
+import time
+from telegram import ChatMember, Update
+from telegram.ext import ChatMemberHandler, ContextTypes
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ADMIN_STATUSES = (ChatMember.ADMINISTRATOR, ChatMember.OWNER)
+
+
+def _key(chat_id, user_id):
+    # GROUPID-style "-100123" strings and the ints Telegram sends must share one entry
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        pass
+    return chat_id, user_id
+
+
+class AdminCache:
+    """Admin status per (chat_id, user_id) with TTL expiry.
+
+    Entries are dropped as soon as a chat_member update reports a status
+    change, so the TTL only bounds staleness when those updates are missed
+    (e.g. the bot is not an admin of the group).
+    """
+
+    def __init__(self, ttl=300.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}   # (chat_id, user_id) -> (is_admin, expires_at)
+        self._inflight = {}  # (chat_id, user_id) -> Task, so concurrent misses share one API call
+        self._generations = {}  # (chat_id, user_id) -> evictions so far; a lookup stores only if unchanged
+
+    async def is_admin(self, bot, chat_id, user_id):
+        key = _key(chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(bot, key, self._generations.get(key, 0)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _lookup(self, bot, key, generation):
+        member = await bot.get_chat_member(*key)
+        result = member.status in ADMIN_STATUSES
+        if self._generations.get(key, 0) != generation:
+            return result  # evicted while the request was out; the answer may predate the change
+        if len(self._entries) >= self.max_entries:
+            self._prune()
+        self._entries[key] = (result, time.monotonic() + self.ttl)
+        return result
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+        # Still full of live entries: drop the oldest half (dicts keep insertion order)
+        if len(self._entries) >= self.max_entries:
+            for key in list(self._entries)[:len(self._entries) // 2]:
+                del self._entries[key]
+
+    def evict(self, chat_id, user_id):
+        key = _key(chat_id, user_id)
+        self._entries.pop(key, None)
+        if len(self._generations) >= self.max_entries:
+            # Only lookups still out need their key's count
+            self._generations = {k: g for k, g in self._generations.items() if k in self._inflight}
+        self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    async def on_chat_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        change = update.chat_member or update.my_chat_member
+        if change.old_chat_member.status != change.new_chat_member.status:
+            logger.debug("Member %s in chat %s: %s -> %s", change.new_chat_member.user.id, change.chat.id,
+                         change.old_chat_member.status, change.new_chat_member.status)
+            self.evict(change.chat.id, change.new_chat_member.user.id)
+
+    def handler(self):
+        """ChatMemberHandler that keeps the cache in step with promotions and demotions.
+
+        chat_member updates are only delivered when requested, so run the
+        application with allowed_updates=Update.ALL_TYPES.
+        """
+        return ChatMemberHandler(self.on_chat_member, ChatMemberHandler.ANY_CHAT_MEMBER)
+
+
+admin_cache = AdminCache(ttl=float(os.getenv("ADMIN_CACHE_TTL", "300")))
+metrics.add_collector("admin_cache", admin_cache.stats)
@@ -0,0 +1,276 @@
+"""Micro-benchmarks of the bot handlers against in-memory backends.
+
+    python bench_handlers.py                       # sizes 10, 1000, 100000
+    python bench_handlers.py --sizes 10,1000 --repeat 50 --json bench.json
+
+The real handler functions are called with stub Update/Context objects
+(replies are recorded, nothing goes to Telegram). event_serve runs on a
+SQLite :memory: database, serve2 on mongomock_motor (or a real server with
+--mongo-uri; the database named by --mongo-db is dropped) and serve3 on a
+temporary state database. For each size the databases are seeded with that
+many registrations, spread over size/100 events, so the per-handler timings
+show how each one scales. event_serve handlers also report the SQL
+statements per call, which makes an N+1 query pattern obvious. mongomock
+scans collections without indexes, so for index behaviour run serve2
+against a real server.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+EVENT_NAME = "Bench Drive 0"
+FIRST_USER_ID = 1000000
+
+
+# --- Stubs ---
+
+class StubBot:
+    """Accepts any Bot API call and counts it; send_poll returns a message with a fresh poll id."""
+
+    def __init__(self):
+        self.calls = 0
+        self._ids = itertools.count(1)
+
+    async def _call(self, *args, **kwargs):
+        self.calls += 1
+        n = next(self._ids)
+        return SimpleNamespace(message_id=n, poll=SimpleNamespace(id=str(n)))
+
+    def __getattr__(self, name):
+        return self._call
+
+
+def stub_user(user_id):
+    return SimpleNamespace(id=user_id, first_name=f"User{user_id}", full_name=f"User {user_id}", is_bot=False)
+
+
+def message_update(bot, user_id, text):
+    user = stub_user(user_id)
+    message = SimpleNamespace(text=text, from_user=user, chat_id=user_id, reply_text=bot._call)
+    return SimpleNamespace(message=message, effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+                           callback_query=None, poll_answer=None)
+
+
+def callback_update(bot, user_id, data):
+    user = stub_user(user_id)
+    query = SimpleNamespace(data=data, from_user=user, answer=bot._call, edit_message_text=bot._call,
+                            message=SimpleNamespace(reply_text=bot._call, chat_id=user_id))
+    return SimpleNamespace(message=None, effective_user=user, effective_chat=SimpleNamespace(id=user_id),
+                           callback_query=query, poll_answer=None)
+
+
+def context(bot, args=(), user_data=None):
+    return SimpleNamespace(bot=bot, args=list(args), user_data={} if user_data is None else user_data)
+
+
+# --- Measurement ---
+
+async def measure(results, size, name, repeat, call, statements=None):
+    """Time repeat awaits of call() (a coroutine factory) and add a result row."""
+    samples = []
+    counted = statements[0] if statements else 0
+    for i in range(repeat):
+        started = time.perf_counter()
+        await call(i)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    row = {
+        "handler": name,
+        "size": size,
+        "calls": repeat,
+        "median_us": round(statistics.median(samples) * 1e6, 1),
+        "p95_us": round(samples[min(len(samples) - 1, int(0.95 * len(samples)))] * 1e6, 1),
+        "mean_us": round(statistics.fmean(samples) * 1e6, 1),
+    }
+    if statements:
+        row["statements_per_call"] = round((statements[0] - counted) / repeat, 1)
+    results.append(row)
+    print(f"{name:<34} {size:>7} {row['median_us']:>11} {row['p95_us']:>11}"
+          f"{row.get('statements_per_call', ''):>8}", flush=True)
+
+
+# --- event_serve (SQLite :memory:) ---
+
+async def bench_event_serve(results, sizes, repeat):
+    os.environ["EVENT_DB"] = ":memory:"
+    event_serve = importlib.import_module("event_serve")
+    import migrations
+    from storage import Database
+    from repository import CachedRepository, SQLiteRepository
+    logging.getLogger().setLevel(logging.WARNING)
+    bot = StubBot()
+
+    for size in sizes:
+        event_serve.db.close()
+        db = event_serve.db = Database(":memory:")
+        db.run_sync(migrations.migrate)
+        event_serve.repo = CachedRepository(SQLiteRepository(db))
+        events = max(1, size // 100)
+        await db.executemany("INSERT INTO events (name, edate, etime, starts_at) VALUES (?, ?, ?, ?)",
+                             [(f"Bench Drive {i}", "2099-01-01", "07:00", f"2099-01-01 07:{i % 60:02d}")
+                              for i in range(events)])
+        await db.executemany("INSERT INTO profiles (user_id, shortname, drives, safety_equipment, car_details) "
+                             "VALUES (?, ?, ?, 'yes', 'Patrol')", [(i, f"user{i}", i % 20) for i in range(size)])
+        await db.executemany("INSERT INTO registrations (user_id, event_id, shortname, consent_accepted) "
+                             "VALUES (?, ?, ?, 1)", [(i, i % events + 1, f"user{i}") for i in range(size)])
+        # :memory: databases have a single connection, so this sees every statement
+        statements = [0]
+        def count(_):
+            statements[0] += 1
+        db.run_sync(lambda conn: conn.set_trace_callback(count))
+
+        await measure(results, size, "event_serve.list_events", repeat,
+                      lambda i: event_serve.list_events(message_update(bot, 1, "/events"), context(bot)), statements)
+        await measure(results, size, "event_serve.list_events all", repeat,
+                      lambda i: event_serve.list_events(message_update(bot, 1, "/events all"), context(bot, ["all"])),
+                      statements)
+        await measure(results, size, "event_serve.register", repeat,
+                      lambda i: event_serve.register(message_update(bot, FIRST_USER_ID + i, "/register"),
+                                                     context(bot, EVENT_NAME.split())), statements)
+
+        async def registration_flow(i):
+            # /register then every step of handle_message, as a brand-new participant
+            user_id, user_data = FIRST_USER_ID + size + i, {}
+            await event_serve.register(message_update(bot, user_id, "/register"),
+                                       context(bot, EVENT_NAME.split(), user_data))
+            for text in (f"bench{i}", "3", "yes", "Patrol 2019", "yes"):
+                await event_serve.handle_message(message_update(bot, user_id, text), context(bot, (), user_data))
+        await measure(results, size, "event_serve.handle_message flow", repeat, registration_flow, statements)
+        await measure(results, size, "event_serve.list_participants", repeat,
+                      lambda i: event_serve.list_participants(message_update(bot, 1, "/participants"),
+                                                              context(bot, EVENT_NAME.split())), statements)
+        db.run_sync(lambda conn: conn.set_trace_callback(None))
+
+
+# --- serve2 (mongomock_motor or a real MongoDB) ---
+
+async def bench_serve2(results, sizes, repeat, mongo_uri, mongo_db):
+    # serve2 builds its (lazily connecting) client at import time; the handlers get the benchmark database below
+    os.environ["MONGO_URI"] = mongo_uri or os.getenv("MONGO_URI") or "mongodb://127.0.0.1:27017"
+    try:
+        serve2 = importlib.import_module("serve2")
+        from repository import CachedRepository, MongoRepository
+        if mongo_uri:
+            import mongo
+            client = mongo.connect(mongo_uri)
+        else:
+            from mongomock_motor import AsyncMongoMockClient
+            client = AsyncMongoMockClient()
+    except ImportError as e:
+        print(f"Skipping serve2: {e} (install motor and mongomock-motor, or pass --mongo-uri)")
+        return
+    logging.getLogger().setLevel(logging.WARNING)
+    bot = StubBot()
+
+    for size in sizes:
+        await client.drop_database(mongo_db)
+        db = serve2.db = client[mongo_db]
+        serve2.users_col, serve2.events_col, serve2.registrations_col = db["users"], db["events"], db["registrations"]
+        serve2.repo = CachedRepository(MongoRepository(db))
+        serve2.views.clear()
+        if mongo_uri:
+            import mongo
+            await mongo.ensure_indexes(db)
+        events = max(1, size // 100)
+        await db["events"].insert_many([
+            {"event_id": e, "date": "2099-01-%02d" % (e % 28 + 1), "location": f"Dunes {e}", "min_level": "Open",
+             "published": True} for e in range(1, events + 1)])
+        await db["users"].insert_many([
+            {"user_id": u, "screen_name": f"user{u}", "car": "Patrol", "drives": u % 20} for u in range(size)])
+        await db["registrations"].insert_many([
+            {"event_id": u % events + 1, "user_id": u} for u in range(size)])
+
+        async def upcoming_cold(i):
+            serve2.views.clear()
+            await serve2.user_list_upcoming(callback_update(bot, 1, "user_list_upcoming"), context(bot))
+        await measure(results, size, "serve2.user_list_upcoming", repeat, upcoming_cold)
+        await measure(results, size, "serve2.user_list_upcoming cached", repeat,
+                      lambda i: serve2.user_list_upcoming(callback_update(bot, 1, "user_list_upcoming"), context(bot)))
+        # User 0 has a profile and alternately unregisters from and registers for event 1
+        await measure(results, size, "serve2.user_toggle_registration", repeat,
+                      lambda i: serve2.user_toggle_registration(callback_update(bot, 0, "user_toggle_reg_1"), context(bot)))
+        await measure(results, size, "serve2.admin_view_regs", repeat,
+                      lambda i: serve2.admin_view_regs(callback_update(bot, 1, "admin_view_regs_1"), context(bot)))
+    await client.drop_database(mongo_db)
+
+
+# --- serve3 (temporary state database) ---
+
+async def bench_serve3(results, sizes, repeat, workdir):
+    os.environ["STATE_DB"] = os.path.join(workdir, "state.db")
+    os.environ["RESPONSES_DIR"] = os.path.join(workdir, "responses")
+    os.environ["MEDIA_CACHE"] = os.path.join(workdir, "media_cache.json")
+    os.environ.setdefault("QUESTIONS_DIR", os.path.dirname(os.path.abspath(__file__)))
+    serve3 = importlib.import_module("serve3")
+    logging.getLogger().setLevel(logging.WARNING)
+    bot = StubBot()
+    questions = serve3.questionnaires.get("drive")
+    first_poll = next(i for i, q in enumerate(questions) if q.kind == "poll")
+
+    for size in sizes:
+        # size concurrent questionnaire sessions, each waiting on its first poll
+        for user_id in range(size):
+            state = serve3.store.start(user_id)
+            state.current_q = first_poll
+            serve3.store.save(state)
+            serve3.store.bind_poll(f"p{user_id}", user_id)
+
+        async def answer(i):
+            user_id = i % size
+            state = serve3.store.get(user_id)
+            state.current_q, state.answers = first_poll, []
+            serve3.store.bind_poll(f"p{user_id}", user_id)
+            update = SimpleNamespace(poll_answer=SimpleNamespace(poll_id=f"p{user_id}", option_ids=[0],
+                                                                 user=stub_user(user_id)))
+            await serve3.receive_poll_answer(update, context(bot))
+        await measure(results, size, "serve3.receive_poll_answer", repeat, answer)
+        for user_id in range(size):
+            serve3.store.finish(user_id)
+    await serve3.store.close()
+    serve3.responses.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bot handlers against in-memory backends.")
+    parser.add_argument("--sizes", default="10,1000,100000", help="comma-separated registration counts")
+    parser.add_argument("--repeat", type=int, default=100, help="calls per handler and size")
+    parser.add_argument("--bots", default="event_serve,serve2,serve3")
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of mongomock_motor")
+    parser.add_argument("--mongo-db", default="eventbot_bench", help="serve2 database (dropped before and after)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+    if args.mongo_db == "eventbot":
+        sys.exit("Refusing to benchmark against the production 'eventbot' database.")
+    sizes = [int(s) for s in args.sizes.split(",")]
+    bots = args.bots.split(",")
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+    results = []
+    print(f"{'handler':<34} {'size':>7} {'median µs':>11} {'p95 µs':>11} {'stmts':>7}")
+
+    async def run():
+        with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+            if "event_serve" in bots:
+                await bench_event_serve(results, sizes, args.repeat)
+            if "serve2" in bots:
+                await bench_serve2(results, sizes, args.repeat, args.mongo_uri, args.mongo_db)
+            if "serve3" in bots:
+                await bench_serve3(results, sizes, args.repeat, workdir)
+    asyncio.run(run())
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"sizes": sizes, "repeat": args.repeat, "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Benchmark of the repository backends, with and without the cache.
+
+    python bench_repository.py                     # 1000 registrations over 20 events
+    python bench_repository.py --registrations 20000 --events 200 --json repo.json
+
+The same workload runs against SQLiteRepository (a :memory: database) and
+MongoRepository (mongomock_motor, or a real server with --mongo-uri; the
+database named by --mongo-db is dropped), each used directly and through
+CachedRepository. Both are seeded through the repository interface, so
+the numbers compare like with like: operations per second for the event
+lookups, profile lookups, registration checks and a register/unregister
+pair.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from repository import CachedRepository, MongoRepository, SQLiteRepository
+
+
+async def seed(repo, events, registrations):
+    for e in range(events):
+        await repo.add_event({"name": f"Bench Drive {e}", "date": "2099-01-%02d" % (e % 28 + 1), "time": "07:00",
+                              "location": f"Dunes {e}", "min_level": "Open", "published": True})
+    event_ids = [e["event_id"] for e in await repo.all_events()]
+    for u in range(registrations):
+        await repo.add_profile(u, {"screen_name": f"user{u}", "car": "Patrol", "drives": u % 20,
+                                   "safety_equipment": "yes"})
+        await repo.add_registration(event_ids[u % len(event_ids)], u)
+    return event_ids
+
+
+async def measure(results, backend, name, repeat, call):
+    started = time.perf_counter()
+    for i in range(repeat):
+        await call(i)
+    elapsed = time.perf_counter() - started
+    row = {"backend": backend, "operation": name, "calls": repeat,
+           "ops_per_s": round(repeat / elapsed, 1), "mean_us": round(elapsed / repeat * 1e6, 1)}
+    results.append(row)
+    print(f"{backend:<16} {name:<22} {row['ops_per_s']:>12} {row['mean_us']:>10}", flush=True)
+
+
+async def bench(results, backend, repo, event_ids, registrations, repeat):
+    users = max(1, registrations)
+    await measure(results, backend, "get_event", repeat, lambda i: repo.get_event(event_ids[i % len(event_ids)]))
+    await measure(results, backend, "find_event", repeat, lambda i: repo.find_event(f"Bench Drive {i % len(event_ids)}"))
+    await measure(results, backend, "list_events", repeat,
+                  lambda i: repo.list_events(since="2099-01-01", published_only=True))
+    # A small working set of returning users, as in a registration burst
+    await measure(results, backend, "get_profile", repeat, lambda i: repo.get_profile(i % min(users, 100)))
+    await measure(results, backend, "is_registered", repeat,
+                  lambda i: repo.is_registered(event_ids[i % len(event_ids)], i % users))
+
+    async def toggle(i):
+        # User 0 unregisters from and registers again for their event
+        event_id = event_ids[0]
+        if not await repo.remove_registration(event_id, 0):
+            await repo.add_registration(event_id, 0)
+    await measure(results, backend, "toggle_registration", repeat, toggle)
+
+
+async def bench_sqlite(results, args):
+    import migrations
+    from storage import Database
+    for cached in (False, True):
+        db = Database(":memory:")
+        db.run_sync(migrations.migrate)
+        repo = SQLiteRepository(db)
+        event_ids = await seed(repo, args.events, args.registrations)
+        if cached:
+            repo = CachedRepository(repo)
+        await bench(results, "sqlite+cache" if cached else "sqlite", repo, event_ids, args.registrations, args.repeat)
+        db.close()
+
+
+async def bench_mongo(results, args):
+    try:
+        if args.mongo_uri:
+            import mongo
+            client = mongo.connect(args.mongo_uri)
+        else:
+            from mongomock_motor import AsyncMongoMockClient
+            client = AsyncMongoMockClient()
+    except ImportError as e:
+        print(f"Skipping MongoDB: {e} (install motor and mongomock-motor, or pass --mongo-uri)")
+        return
+    for cached in (False, True):
+        await client.drop_database(args.mongo_db)
+        db = client[args.mongo_db]
+        if args.mongo_uri:
+            import mongo
+            await mongo.ensure_indexes(db)
+        repo = MongoRepository(db)
+        event_ids = await seed(repo, args.events, args.registrations)
+        if cached:
+            repo = CachedRepository(repo)
+        await bench(results, "mongo+cache" if cached else "mongo", repo, event_ids, args.registrations, args.repeat)
+    await client.drop_database(args.mongo_db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repository backends with and without the cache.")
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--registrations", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=1000, help="calls per operation and backend")
+    parser.add_argument("--backends", default="sqlite,mongo")
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of mongomock_motor")
+    parser.add_argument("--mongo-db", default="eventbot_bench", help="database to use (dropped before and after)")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args()
+    if args.mongo_db == "eventbot":
+        sys.exit("Refusing to benchmark against the production 'eventbot' database.")
+    args.events = max(1, args.events)
+    backends = args.backends.split(",")
+    logging.basicConfig(level=logging.WARNING)
+
+    results = []
+    print(f"{'backend':<16} {'operation':<22} {'ops/s':>12} {'mean µs':>10}")
+
+    async def run():
+        if "sqlite" in backends:
+            await bench_sqlite(results, args)
+        if "mongo" in backends:
+            await bench_mongo(results, args)
+    asyncio.run(run())
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"events": args.events, "registrations": args.registrations, "repeat": args.repeat,
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import os
-import sqlite3
 import logging
+import sqlite3
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram import ChatMember
@@ -8,47 +8,35 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
     ContextTypes, filters
 )
+import migrations
+from admin_cache import admin_cache
+import runner
+from storage import Database
+from slowlog import slowlog
+from metrics import metrics
+from repository import PROFILES, CachedRepository, SQLiteRepository
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 # Database setup
-db_file = "registrations.db"
-conn = sqlite3.connect(db_file, check_same_thread=False)
-c = conn.cursor()
-
-# Create tables if they do not exist
-c.execute('''CREATE TABLE IF NOT EXISTS events (
-                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT,
-                edate TEXT,
-                etime TEXT,
-                location_name TEXT,
-                level TEXT,
-                published INTEGER,
-                location_coordinates TEXT)''')
-
-c.execute('''CREATE TABLE IF NOT EXISTS registrations (
-                user_id INTEGER,
-                event_id INTEGER,
-                shortname TEXT,
-                drives INTEGER,
-                safety_equipment TEXT,
-                car_details TEXT,
-                consent_accepted BOOLEAN,
-                PRIMARY KEY (user_id, event_id),
-                FOREIGN KEY (event_id) REFERENCES events(event_id))''')
-conn.commit()
-
-# Function to get admin IDs from the channel
-async def get_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> list:
-    logger.debug("Getting admins for chat %s", update.message.chat_id)
+db_file = os.getenv("EVENT_DB", "registrations.db")
+db = Database(db_file, pool_size=int(os.getenv("DB_POOL_SIZE", "4")))
+
+# Bring the schema up to date (creates the tables on a fresh database)
+db.run_sync(migrations.migrate)
+
+# Event and profile lookups, served from memory between writes (see repository.CachedRepository)
+repo = CachedRepository(SQLiteRepository(db))
+metrics.add_collector("repository", repo.stats)
+
+# Check whether the sender is an admin of the current chat (cached, see admin_cache)
+async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     chat_id = update.message.chat_id
-    admins = await context.bot.get_chat_administrators(chat_id)
-    admin_ids = [admin.user.id for admin in admins]
-    logger.debug("Admins retrieved: %s", admin_ids)
-    return admin_ids
+    admin = await admin_cache.is_admin(context.bot, chat_id, update.effective_user.id)
+    logger.debug("User %s admin in chat %s: %s (cache %s)", update.effective_user.id, chat_id, admin, admin_cache.stats())
+    return admin
 
 # Start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -61,19 +49,15 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat = update.effective_chat
     logger.info("User %s asked for help from bot. chatid: %d", user.full_name, chat.id)
     await update.message.reply_text(f"Hello {user.full_name}, These are the available commands: \n/events to list the currently available drives\n/register <drivename> to register for a specific drive\n")
-    admins = await  get_admins(update, context)
-    #admin_ids = [admin.user.id for admin in admins ]
-    logger.debug("ADMINS: %s", admins)
-    if user.id in admins:
+    if await is_admin(update, context):
         logger.info("Admin commands for user %s", user.full_name)
         await update.message.reply_text(f"Admin commands: \n/create_event <event shortname> to initiate a drive creation\n/participants <event shortname>\n/publish_event <event shortname> to make the drive selectable for registration\n/modify_event <event shortname> to initiate modification to drive details")
 
 # Create event command (admin only)
 async def create_event2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    admin_ids = await get_admins(update, context)
     user_id = update.message.from_user.id
 
-    if user_id in admin_ids:
+    if await is_admin(update, context):
         try:
             name = context.args[0]
             date = context.args[1]
@@ -81,9 +65,8 @@ async def create_event2(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             location_name = context.args[3]
             location_coordinates = context.args[4]
 
-            c.execute('INSERT INTO events (name, date, time, location_name, location_coordinates) VALUES (?, ?, ?, ?, ?)', 
+            await db.execute('INSERT INTO events (name, date, time, location_name, location_coordinates) VALUES (?, ?, ?, ?, ?)', 
                       (name, date, time, location_name, location_coordinates))
-            conn.commit()
 
             await update.message.reply_text(f"Event '{name}' created successfully.")
             logger.info("Event '%s' created by admin %d", name, user_id)
@@ -103,9 +86,8 @@ async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             event_name = " ".join(context.args)
 
             if chat.type != "private":  # If in a group chat
-                member = await context.bot.get_chat_member(chat.id, user_id)
                 logger.info("chat id: %d", chat.id)
-                if member.status not in ["administrator", "creator"]:
+                if not await admin_cache.is_admin(context.bot, chat.id, user_id):
                     await update.message.reply_text("🚫 Only group admins can create events.")
                     return
 
@@ -146,11 +128,14 @@ async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     location_coordinates = context.user_data.get("location_coordinates")
     logger.debug("event save with name %s date %s time %s location %s level %s and coord %s", event_name, event_date, event_time, location_name, level, location_coordinates)
     
-    c.execute(
-        "INSERT INTO events (name, edate, etime, location_name, location_coordinates) VALUES (?, ?, ?, ?, ?)",
-        (event_name, event_date, event_time, location_name, location_coordinates)
-    )
-    conn.commit()
+    try:
+        await repo.add_event({"name": event_name, "date": event_date, "time": event_time,
+                              "location": location_name, "coordinates": location_coordinates})
+    except sqlite3.IntegrityError:
+        await update.message.reply_text(f"🚫 An event named '{event_name}' already exists. Use /create_event to start again with another name.")
+        logger.warning("Duplicate event name %s", event_name)
+        context.user_data.clear()
+        return
     logger.debug("event save after commit")
 
     await update.message.reply_text(f"✅ Event '{event_name}' created for {event_date} at {event_time}.")
@@ -159,6 +144,95 @@ async def save_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
 
 
+# Rows per page for /events and /participants; keeps replies far below
+# Telegram's 4096-character limit.
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "20"))
+
+# Single query per page: events come off the starts_at index in order (the
+# index implicitly ends in event_id, the rowid) and each participant count
+# is an index-only lookup on registrations(event_id).
+EVENT_LISTING_SQL = """SELECT e.starts_at, e.event_id, e.name, e.edate, e.etime, e.location_name, e.location_coordinates,
+                              (SELECT COUNT(*) FROM registrations r WHERE r.event_id = e.event_id)
+                       FROM events e
+                       WHERE {where} {seek}
+                       ORDER BY e.starts_at {order}, e.event_id {order}
+                       LIMIT ?"""
+
+# Participants in registration order, seeking on the registrations(event_id) index;
+# the short name given for this event, drive counts from profiles by primary key
+PARTICIPANTS_SQL = """SELECT r.rowid, COALESCE(r.shortname, p.shortname), p.drives, e.name
+                      FROM registrations r JOIN events e ON e.event_id = r.event_id
+                      LEFT JOIN profiles p ON p.user_id = r.user_id
+                      WHERE r.event_id = ? {seek}
+                      ORDER BY r.rowid {order}
+                      LIMIT ?"""
+
+async def fetch_page(sql, params, key_columns, direction=None, key=()):
+    """Keyset (seek) pagination: one bounded query per page, whatever the offset.
+
+    direction is None for the first page, "n" for the page after key and "p"
+    for the page before it. Returns (rows, has_prev, has_next).
+    """
+    if direction == "n":
+        seek, order = f"AND ({key_columns}) > ({', '.join('?' * len(key))})", "ASC"
+    elif direction == "p":
+        seek, order = f"AND ({key_columns}) < ({', '.join('?' * len(key))})", "DESC"
+    else:
+        seek, order, key = "", "ASC", ()
+    rows = await db.fetchall(sql.format(seek=seek, order=order), (*params, *key, PAGE_SIZE + 1))
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if direction == "p":
+        rows.reverse()
+        return rows, more, True
+    return rows, direction == "n", more
+
+def page_buttons(prefix, first_key, last_key, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}|p|{first_key}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}|n|{last_key}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+def weekday(edate):
+    # Format the date to show the day of the week (e.g., Monday for 2025-03-29)
+    return datetime.strptime(edate, "%Y-%m-%d").strftime('%A')
+
+async def events_page(scope, direction=None, key=()):
+    """Text and pager keyboard for one page of events; scope is "all", "up" (upcoming) or an event name."""
+    if scope == "all":
+        where, params = "1", ()
+    elif scope == "up":
+        # Range filter on the indexed starts_at column ('YYYY-MM-DD HH:MM'), so
+        # everything from the start of today onwards is listed.
+        where, params = "e.starts_at >= date('now', 'localtime')", ()
+    else:
+        where, params = "e.name = ?", (scope,)
+    events, has_prev, has_next = await fetch_page(EVENT_LISTING_SQL.format(where=where, seek="{seek}", order="{order}"),
+                                                  params, "e.starts_at, e.event_id", direction, key)
+    if not events:
+        return None, None
+
+    event_list = ""
+    for event in events:
+        _, event_id, name, edate, etime, location_name, location_coordintates, participant_count = event
+        if scope == "up":
+            event_list += f"{name} on {weekday(edate)} {edate} at {etime} - {participant_count} participant(s)\n"
+            continue
+        if not location_name:
+            location_name = "."
+        event_list += f"{name} on {weekday(edate)} {edate} at {etime} at {location_name} - {participant_count} participant(s)\n"
+        if location_coordintates:
+            event_list += f"{location_coordintates}\n"
+        event_list+=f"\n"
+    header = "Upcoming events" if scope == "up" else "Events"
+    # Named lookups hit the unique name index and never span pages
+    markup = None
+    if scope in ("all", "up"):
+        markup = page_buttons(f"events|{scope}", events[0][1], events[-1][1], has_prev, has_next)
+    return f"{header}:\n{event_list}", markup
+
 # List events command
 async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
@@ -167,29 +241,9 @@ async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             event_name = " ".join(context.args)
             logger.debug(f"list event: {event_name}")
 
-            if event_name.lower() == "all":
-                c.execute("SELECT event_id, name, edate, etime, location_name, location_coordinates FROM events")
-            else:
-                c.execute("SELECT event_id, name, edate, etime, location_name, location_coordinates FROM events WHERE name = ?", (event_name,))
-            events = c.fetchall()
-            if events:
-                
-                event_list = ""
-                for event in events:
-                    event_id, name, edate, etime, location_name, location_coordintates = event
-
-                    event_date = datetime.strptime(edate, "%Y-%m-%d").strftime("%A, %Y-%m-%d")
-                    day = datetime.strptime(event_date, "%Y-%m-%d").strftime('%A')
-         
-                    c.execute("SELECT COUNT(*) FROM registrations WHERE event_id = ?", (event_id,))
-                    participant_count = c.fetchone()[0]
-                    if not location_name:
-                        location_name = "."
-                    event_list += f"{name} on {day} {event_date} at {etime} at {location_name} - {participant_count} participant(s)\n"
-                    if location_coordintates:
-                        event_list += f"{location_coordintates}\n"
-                    event_list+=f"\n"
-                await update.message.reply_text(f"Events:\n{event_list}")
+            text, markup = await events_page("all" if event_name.lower() == "all" else event_name)
+            if text:
+                await update.message.reply_text(text, reply_markup=markup)
             else:
                 await update.message.reply_text("No events found.")
         except ValueError:
@@ -197,29 +251,29 @@ async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             logger.error("Invalid event input.")
     else:
         try:
-            c.execute("SELECT event_id, name, edate, etime FROM events WHERE edate >= date('today')")
-            events = c.fetchall()
-            if events:
-                event_list = ""
-                for event in events:
-                    event_id, name, edate, etime = event
-                    # Format the date to show the day of the week (e.g., Monday, 2025-03-29)
-                    event_date = datetime.strptime(edate, "%Y-%m-%d").strftime("%A, %Y-%m-%d")
-                    day = datetime.strptime(event_date, "%Y-%m-%d").strftime('%A')
-
-                    # Count the number of participants registered for the event
-                    c.execute("SELECT COUNT(*) FROM registrations WHERE event_id = ?", (event_id,))
-                    participant_count = c.fetchone()[0]
-
-                    event_list += f"{name} on {day} {event_date} at {etime} - {participant_count} participant(s)\n"
-
-                await update.message.reply_text(f"Upcoming events:\n{event_list}")
+            text, markup = await events_page("up")
+            if text:
+                await update.message.reply_text(text, reply_markup=markup)
             else:
                 await update.message.reply_text("No upcoming events found.")
         except ValueError:
             await update.message.reply_text("Error in events. Use /events to see available events.")
             logger.error("Error in events.")
 
+# Next/prev buttons of /events: events|<scope>|<n|p>|<event_id>. Only the id travels
+# in callback_data (64 bytes at most); the starts_at half of the key is looked up.
+async def list_events_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    parts = query.data.split("|")
+    scope, direction, event_id = parts[1], parts[2], int(parts[-1])
+    row = await db.fetchone("SELECT starts_at FROM events WHERE event_id = ?", (event_id,))
+    if row is None:
+        await query.edit_message_text("No more events.")
+        return
+    text, markup = await events_page(scope, direction, (row[0], event_id))
+    await query.edit_message_text(text or "No more events.", reply_markup=markup)
+
 # Register command
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.message.from_user
@@ -228,18 +282,13 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:
         try:
             event_name = " ".join(context.args)
-            c.execute("SELECT event_id, name FROM events WHERE name = ?", (event_name,))
-            event = c.fetchone()
+            event = await repo.find_event(event_name)
 
             if event:
-                event_id = event[0]
+                event_id = event["event_id"]
                 logger.debug("Event found: %s (ID: %d)", event_name, event_id)
 
-                c.execute("SELECT * FROM registrations WHERE user_id = ? AND event_id = ?", (user.id, event_id))
-                registration = c.fetchone()
-
-                if registration:
-                    current_drives = registration[3]
+                if await repo.is_registered(event_id, user.id):
                     await update.message.reply_text(f"You are already registered for the {event_name} drive.")
                     logger.debug("User %s is already registered for %s drive", user.id, event_id)
                     #await update.message.reply_text("Would you like to update the number of drives? (Reply with the new number of drives or type 'no' to cancel)")
@@ -248,11 +297,13 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     #context.user_data['step'] = 'reg_update_drives'
                     context.user_data.clear()
                 else:
-                    c.execute("SELECT shortname FROM registrations WHERE user_id = ?", (user.id,))
-                    profile = c.fetchone()
+                    profile = await repo.get_profile(user.id)
 
                     if profile:
-                        # If profile exists, just ask for the shortname.
+                        # If profile exists, just ask for the shortname; the rest is reused.
+                        context.user_data['drives'] = profile['drives'] or 0
+                        context.user_data['safety_equipment'] = profile['safety_equipment']
+                        context.user_data['car_details'] = profile['car']
                         await update.message.reply_text("Please provide your short name for the registration.")
                         context.user_data['awaiting_event_id'] = event_id
                         context.user_data['flow'] = "reg"
@@ -329,13 +380,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             elif step == 'event_consent':
                 consent = update.message.text
                 if consent.lower() == 'yes':
-                    c.execute("REPLACE INTO registrations (user_id, event_id, shortname, drives, safety_equipment, car_details, consent_accepted) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-                              (user.id, event_id, context.user_data['shortname'], context.user_data['drives'], context.user_data['safety_equipment'], context.user_data['car_details'], True))
-                    conn.commit()
-
-                    # Increment the number of drives by 1 after successful registration.
-                    c.execute("UPDATE registrations SET drives = drives + 1 WHERE user_id = ? AND event_id = ?", (user.id, event_id))
-                    conn.commit()
+                    # The registration counts as one more drive; the profile update and the
+                    # registration are one transaction instead of a follow-up UPDATE and commit.
+                    await repo.add_registration(event_id, user.id, {
+                        "screen_name": context.user_data['shortname'], "drives": context.user_data['drives'] + 1,
+                        "safety_equipment": context.user_data['safety_equipment'], "car": context.user_data['car_details'],
+                        "consent_accepted": True})
 
                     await update.message.reply_text(f"{user.full_name}, you have been successfully registered for {context.user_data['drives']} drive(s) in event {event_id}!")
                     logger.info("User %s successfully registered for event %d", user.id, event_id)
@@ -348,9 +398,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 try:
                     new_drives = int(update.message.text)
                     if new_drives >= 0:
-                        c.execute("UPDATE registrations SET drives = ? WHERE user_id = ? AND event_id = ?", 
-                                  (new_drives, user.id, event_id))
-                        conn.commit()
+                        await db.execute("UPDATE profiles SET drives = ? WHERE user_id = ?",
+                                  (new_drives, user.id))
+                        await repo.touch(PROFILES)  # written outside the repository
                         await update.message.reply_text(f"Your number of drives has been updated to {new_drives}.")
                         logger.info("User %s updated drives for event %d to %d", user.id, event_id, new_drives)
                     else:
@@ -429,23 +479,28 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("unknown event.")
         logger.debug("Unknown event for user %s", user.id)
 
+async def participants_page(event_id, direction=None, key=()):
+    registrations, has_prev, has_next = await fetch_page(PARTICIPANTS_SQL, (event_id,), "r.rowid", direction, key)
+    if not registrations:
+        return None, None
+    participants = "\n".join(f"{shortname} - {drives} drive(s)" for _, shortname, drives, _ in registrations)
+    markup = page_buttons(f"parts|{event_id}", registrations[0][0], registrations[-1][0], has_prev, has_next)
+    return f"Participants for Event '{registrations[0][3]}':\n{participants}", markup
+
 # List participants command
 async def list_participants(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:
         try:
             event_name = " ".join(context.args)
-            c.execute("SELECT event_id FROM events WHERE name = ?", (event_name,))
-            event = c.fetchone()
+            event = await repo.find_event(event_name)
 
             if event:
-                event_id = event[0]
-                c.execute("SELECT shortname, drives FROM registrations WHERE event_id = ? ORDER BY rowid", (event_id,))
-                registrations = c.fetchall()
-
-                if registrations:
-                    participants = "\n".join(f"{shortname} - {drives} drive(s)" for shortname, drives in registrations)
-                    await update.message.reply_text(f"Participants for Event '{event_name}':\n{participants}")
-                    logger.debug("Participants for event '%s': %s", event_name, registrations)
+                event_id = event["event_id"]
+                text, markup = await participants_page(event_id)
+
+                if text:
+                    await update.message.reply_text(text, reply_markup=markup)
+                    logger.debug("Participants for event '%s' sent", event_name)
                 else:
                     await update.message.reply_text("No participants registered for this event yet.")
                     logger.debug("No participants for event '%s'", event_name)
@@ -459,10 +514,25 @@ async def list_participants(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Please specify an event name: /participants <event_name>")
         logger.debug("No event name specified for participants listing")
 
+# Next/prev buttons of /participants: parts|<event_id>|<n|p>|<rowid>
+async def list_participants_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    _, event_id, direction, rowid = query.data.split("|")
+    text, markup = await participants_page(int(event_id), direction, (int(rowid),))
+    await query.edit_message_text(text or "No more participants.", reply_markup=markup)
+
+# Slowest SQL statements since start-up (admins only)
+async def show_slowlog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await is_admin(update, context):
+        await update.message.reply_text("Only admins can view the slow query log.")
+        return
+    await update.message.reply_text(slowlog.summary())
+
 # Main function to run the bot
-def main():
+def build_app():
     bot_token = os.getenv("BOT_TOKEN")
-    app = ApplicationBuilder().token(bot_token).build()
+    app = runner.builder(bot_token).build()
 
     # Add handlers for commands
     app.add_handler(CommandHandler("start", start))
@@ -471,11 +541,19 @@ def main():
     app.add_handler(CommandHandler("events", list_events))
     app.add_handler(CommandHandler("register", register))
     app.add_handler(CommandHandler("participants", list_participants))
+    app.add_handler(CommandHandler("slowlog", show_slowlog))
+    app.add_handler(CallbackQueryHandler(list_events_page, pattern="^events\\|"))
+    app.add_handler(CallbackQueryHandler(list_participants_page, pattern="^parts\\|"))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(admin_cache.handler())
+    return app
+
+def main():
+    app = build_app()
 
-    # Start the bot and handle updates
+    # Start the bot and handle updates (chat_member updates keep the admin cache fresh)
     logger.info("Bot started")
-    app.run_polling()
+    runner.run(app)
 
 # If running in an environment that already has a running loop, use this method:
 if __name__ == "__main__":
@@ -0,0 +1,362 @@
+"""Load test for the bots against a local stand-in for the Telegram Bot API.
+
+    python loadtest.py event_serve --users 200
+    python loadtest.py serve2 --users 500 --mongo-db eventbot_loadtest
+    python loadtest.py serve3 --users 100 --api-latency 0.08
+
+The bot module is imported with its data redirected to a temporary directory
+(EVENT_DB, STATE_DB, RESPONSES_DIR, MEDIA_CACHE) or to a throw-away MongoDB
+database (serve2, MONGO_URI must point at a server), and its Application is
+pointed at FakeBotAPI through BOT_API_BASE_URL. Each simulated user then runs
+one scripted flow, sending the next update only after the previous one was
+handled. Updates go through the application's own update processor and rate
+limiter, so per-user ordering, BOT_WORKERS and outbound pacing all apply.
+
+Reported: updates/s, p50/p99/max latency per update (from hand-over to the
+update processor until all its handlers finished, outbound calls included)
+and the Bot API calls the bot made, per method.
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from email.parser import BytesParser
+from urllib.parse import parse_qsl
+from telegram import Update
+
+logger = logging.getLogger("loadtest")
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+FIRST_USER_ID = 100000
+EVENT_NAME = "Load Test Drive"
+
+
+class FakeBotAPI:
+    """Minimal HTTP/1.1 server answering Bot API methods with plausible results.
+
+    Every call is counted per method and the last one per chat is kept, so
+    scenarios can react to what the bot sent (e.g. answer the poll it just
+    posted). latency delays each response to mimic the round trip to Telegram.
+    """
+
+    def __init__(self, latency=0.05, admins=()):
+        self.latency = latency
+        self.admins = set(admins)
+        self.calls = Counter()
+        self.last = {}  # chat_id -> (method, params, result)
+        self._ids = itertools.count(1)
+        self._server = None
+        self.port = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        self._server = await asyncio.start_server(self._serve, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}/bot"
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                method = request_line.split()[1].decode().rsplit("/", 1)[-1]
+                params = self._parse(headers.get("content-type", ""), body)
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                payload = json.dumps({"ok": True, "result": self._answer(method, params)}).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (len(payload), payload))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse(content_type, body):
+        # python-telegram-bot sends form fields whose values are JSON, or multipart when uploading
+        if content_type.startswith("multipart/"):
+            message = BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+            fields = {part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+                      for part in message.get_payload()}
+            fields = {name: value.decode("utf-8", "replace") for name, value in fields.items()
+                      if not name.startswith("attach")}
+        elif content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        else:
+            fields = dict(parse_qsl(body.decode()))
+        # Only structured values (options, reply_markup, ...) are decoded; ids stay strings
+        return {name: json.loads(value) if value[:1] in "[{" else value for name, value in fields.items()}
+
+    def _message(self, params, **content):
+        chat_id = int(params.get("chat_id", 0))
+        return {"message_id": int(params.get("message_id") or next(self._ids)), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": BOT_USER, **content}
+
+    def _answer(self, method, params):
+        self.calls[method] += 1
+        if method == "getMe":
+            return BOT_USER
+        if method == "getChatMember":
+            user = {"id": int(params["user_id"]), "is_bot": False, "first_name": "Member"}
+            if user["id"] in self.admins:
+                return {"status": "creator", "user": user, "is_anonymous": False}
+            return {"status": "member", "user": user}
+        if method in ("sendMessage", "editMessageText"):
+            result = self._message(params, text=params.get("text", ""))
+        elif method == "sendPoll":
+            poll = {"id": str(next(self._ids)), "question": params.get("question", ""),
+                    "options": [{"text": o if isinstance(o, str) else o["text"], "voter_count": 0}
+                                for o in params.get("options", [])],
+                    "total_voter_count": 0, "is_closed": False, "is_anonymous": False,
+                    "type": "regular", "allows_multiple_answers": False}
+            result = self._message(params, poll=poll)
+        elif method == "sendPhoto":
+            n = next(self._ids)
+            result = self._message(params, caption=params.get("caption", ""),
+                                   photo=[{"file_id": f"photo{n}", "file_unique_id": f"u{n}", "width": 1, "height": 1}])
+        else:
+            result = True
+        if "chat_id" in params:
+            self.last[int(params["chat_id"])] = (method, params, result)
+        return result
+
+
+class Driver:
+    """Feeds synthetic updates to an application and times each one."""
+
+    def __init__(self, app, api, args):
+        self.app = app
+        self.api = api
+        self.args = args
+        self.latencies = []
+        self.errors = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+        logger.debug("Handler error for %s", update, exc_info=context.error)
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+    def chat_message(self, user_id, text):
+        message = {"message_id": next(self._message_ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self.user(user_id), "text": text}
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    async def send(self, data):
+        update = Update.de_json({"update_id": next(self._update_ids), **data}, self.app.bot)
+        started = time.perf_counter()
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        self.latencies.append(time.perf_counter() - started)
+
+    async def message(self, user_id, text):
+        await self.send(self.chat_message(user_id, text))
+
+    async def tap(self, user_id, data):
+        await self.send({"callback_query": {
+            "id": str(next(self._update_ids)), "from": self.user(user_id), "chat_instance": "loadtest", "data": data,
+            "message": {"message_id": next(self._message_ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "menu"}}})
+
+    async def poll_answer(self, user_id, poll_id, option):
+        await self.send({"poll_answer": {"poll_id": poll_id, "user": self.user(user_id), "option_ids": [option]}})
+
+
+# --- Scenarios: environment, seeding and one user's flow per bot ---
+
+def env_event_serve(args, workdir):
+    os.environ["EVENT_DB"] = os.path.join(workdir, "registrations.db")
+
+
+async def seed_event_serve(bot, args):
+    import migrations
+    await bot.db.execute("INSERT INTO events (name, edate, etime, starts_at) VALUES (?, ?, ?, ?)",
+                         (EVENT_NAME, "2099-01-01", "07:00", migrations.starts_at("2099-01-01", "07:00")))
+
+
+async def flow_event_serve(driver, user_id):
+    # New participant registering, then checking the listings
+    for text in (f"/register {EVENT_NAME}", f"user{user_id}", "3", "yes", "Patrol 2019", "yes",
+                 "/events", f"/participants {EVENT_NAME}"):
+        await driver.message(user_id, text)
+
+
+async def cleanup_event_serve(bot, args):
+    bot.db.close()
+
+
+def env_serve2(args, workdir):
+    if args.mongo_db == "eventbot":
+        sys.exit("Refusing to load test against the production 'eventbot' database.")
+    os.environ["MONGO_DB"] = args.mongo_db
+
+
+async def seed_serve2(bot, args):
+    await bot.client.drop_database(args.mongo_db)
+    await bot.events_col.insert_many([
+        {"event_id": event_id, "date": "2099-01-%02d" % event_id, "location": f"Dunes {event_id}",
+         "min_level": "Open", "published": True}
+        for event_id in range(1, args.events + 1)])
+    await bot.users_col.insert_many([
+        {"user_id": FIRST_USER_ID + i, "screen_name": f"user{i}", "car": "Patrol", "drives": 0}
+        for i in range(args.users)])
+
+
+async def flow_serve2(driver, user_id):
+    event_id = user_id % driver.args.events + 1
+    for data in ("user_list_upcoming", f"user_event_detail_{event_id}", f"user_toggle_reg_{event_id}",
+                 f"user_event_detail_{event_id}", "user_my_registrations"):
+        await driver.tap(user_id, data)
+
+
+async def cleanup_serve2(bot, args):
+    if not args.keep_data:
+        await bot.client.drop_database(args.mongo_db)
+
+
+def env_serve3(args, workdir):
+    os.environ["STATE_DB"] = os.path.join(workdir, "state.db")
+    os.environ["RESPONSES_DIR"] = os.path.join(workdir, "responses")
+    os.environ["MEDIA_CACHE"] = os.path.join(workdir, "media_cache.json")
+    os.environ.setdefault("QUESTIONS_DIR", os.path.dirname(os.path.abspath(__file__)))
+
+
+async def flow_serve3(driver, user_id):
+    # Answer whatever the bot asked last: first poll option, a typed answer, then confirm
+    await driver.message(user_id, "/new_drive")
+    for _ in range(100):
+        method, params, result = driver.api.last.get(user_id, (None, {}, None))
+        if method == "sendPoll":
+            await driver.poll_answer(user_id, result["poll"]["id"], 0)
+        elif method == "sendMessage" and "confirm your answers" in params.get("text", ""):
+            await driver.message(user_id, "/Confirm ✅")
+        elif method == "sendMessage" and "confirmed" not in params.get("text", ""):
+            await driver.message(user_id, f"answer from {user_id}")
+        else:
+            return
+
+
+SCENARIOS = {
+    "event_serve": (env_event_serve, seed_event_serve, flow_event_serve, cleanup_event_serve),
+    "serve2": (env_serve2, seed_serve2, flow_serve2, cleanup_serve2),
+    "serve3": (env_serve3, None, flow_serve3, None),
+}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+async def run(args):
+    setup_env, seed, flow, cleanup = SCENARIOS[args.bot]
+    api = FakeBotAPI(latency=args.api_latency)
+    os.environ["BOT_API_BASE_URL"] = await api.start()
+    os.environ["BOT_TOKEN"] = "123456:LOADTEST"
+    if args.workers:
+        os.environ["BOT_WORKERS"] = str(args.workers)
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        setup_env(args, workdir)
+        bot = importlib.import_module(args.bot)
+        logging.getLogger().setLevel(args.log_level)  # the bots configure DEBUG/INFO on import
+
+        app = bot.build_app()
+        driver = Driver(app, api, args)
+        app.add_error_handler(driver.on_error)
+        if seed:
+            await seed(bot, args)
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        try:
+            calls_before = Counter(api.calls)
+            started = time.perf_counter()
+            await asyncio.gather(*(flow(driver, FIRST_USER_ID + i) for i in range(args.users)))
+            elapsed = time.perf_counter() - started
+        finally:
+            if cleanup:
+                await cleanup(bot, args)
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+            await app.shutdown()
+            await api.stop()
+
+    calls = api.calls - calls_before  # without the getMe etc. of start-up
+    report = {
+        "bot": args.bot,
+        "users": args.users,
+        "updates": len(driver.latencies),
+        "errors": driver.errors,
+        "seconds": round(elapsed, 3),
+        "updates_per_second": round(len(driver.latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {name: round(percentile(driver.latencies, q) * 1000, 1)
+                       for name, q in (("p50", 0.50), ("p99", 0.99), ("max", 1.0))},
+        "outbound_calls": sum(calls.values()),
+        "outbound_by_method": dict(calls.most_common()),
+        "update_processor": app.update_processor.stats(),
+        "rate_limiter": app.bot.rate_limiter.stats(),
+    }
+    return report
+
+
+def print_report(report):
+    latency = report["latency_ms"]
+    print(f"{report['bot']}: {report['users']} users, {report['updates']} updates in {report['seconds']}s "
+          f"({report['updates_per_second']}/s), {report['errors']} handler error(s)")
+    print(f"latency p50 {latency['p50']} ms, p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"outbound calls: {report['outbound_calls']} "
+          f"({', '.join(f'{m} {n}' for m, n in report['outbound_by_method'].items())})")
+    limiter = report["rate_limiter"]
+    print(f"outbound queue wait: avg {limiter['avg_wait'] * 1000:.1f} ms, max {limiter['max_wait'] * 1000:.1f} ms, "
+          f"{limiter['retry_after']} RetryAfter, {limiter['merged']} merged")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a bot against a local fake Bot API server.")
+    parser.add_argument("bot", choices=sorted(SCENARIOS))
+    parser.add_argument("--users", type=int, default=100, help="simulated users, all running concurrently")
+    parser.add_argument("--events", type=int, default=5, help="events to spread serve2 users over")
+    parser.add_argument("--workers", type=int, help="BOT_WORKERS for the run (default: environment / 16)")
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds each fake Bot API call takes")
+    parser.add_argument("--mongo-db", default="eventbot_loadtest", help="database serve2 seeds, uses and drops")
+    parser.add_argument("--keep-data", action="store_true", help="don't drop the serve2 database afterwards")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
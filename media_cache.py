@@ -0,0 +1,94 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+from telegram import InputFile
+from telegram.error import BadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class MediaCache:
+    """Remembers the Telegram file_id of each uploaded local asset.
+
+    Entries are keyed by absolute path and SHA-256 of the content, so editing
+    the file uploads it again. Hashes are memoised per (mtime, size), which
+    makes a repeat send cost one stat() and no reads. The mapping is saved
+    to a JSON file so it survives restarts; a file_id Telegram no longer
+    accepts is dropped and the asset is uploaded again. Reading, hashing
+    and saving run on worker threads, never on the event loop.
+    """
+
+    def __init__(self, path="media_cache.json"):
+        self.path = path
+        self._file_ids = {}
+        self._digests = {}  # abs path -> (mtime_ns, size, sha256)
+        self._save_lock = threading.Lock()
+        self._changes = 0  # bumped per change to _file_ids; an older snapshot never overwrites a newer one
+        self._saved = 0
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._file_ids = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring unreadable media cache %s: %s", path, e)
+
+    def _key(self, asset):
+        asset = os.path.abspath(asset)
+        st = os.stat(asset)
+        cached = self._digests.get(asset)
+        if cached and cached[:2] == (st.st_mtime_ns, st.st_size):
+            digest = cached[2]
+        else:
+            with open(asset, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            self._digests[asset] = (st.st_mtime_ns, st.st_size, digest)
+        return f"{asset}|{digest}"
+
+    def _write(self, snapshot, change):
+        with self._save_lock:
+            if change <= self._saved:
+                return
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, indent=1)
+            os.replace(tmp, self.path)
+            self._saved = change
+
+    async def _save(self):
+        # Snapshot on the loop, where _file_ids is changed; write on a thread
+        self._changes += 1
+        await asyncio.to_thread(self._write, dict(self._file_ids), self._changes)
+
+    async def _remember(self, key, file_id):
+        self._file_ids[key] = file_id
+        await self._save()
+
+    async def _forget(self, key):
+        if self._file_ids.pop(key, None) is not None:
+            await self._save()
+
+    @staticmethod
+    def _read(asset):
+        with open(asset, "rb") as f:
+            return f.read()
+
+    async def send_photo(self, bot, chat_id, asset, **kwargs):
+        key = await asyncio.to_thread(self._key, asset)
+        file_id = self._file_ids.get(key)
+        if file_id:
+            try:
+                return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+            except BadRequest as e:
+                if "file" not in e.message.lower():
+                    raise
+                logger.info("Cached file_id for %s rejected (%s), uploading again", asset, e.message)
+                await self._forget(key)
+        data = await asyncio.to_thread(self._read, asset)
+        message = await bot.send_photo(chat_id=chat_id, photo=InputFile(data, filename=os.path.basename(asset)),
+                                       **kwargs)
+        # Largest size last; any of them works as a photo file_id
+        await self._remember(key, message.photo[-1].file_id)
+        return message
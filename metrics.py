@@ -0,0 +1,200 @@
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Series:
+    __slots__ = ("buckets", "sum", "count", "errors", "in_flight")
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+
+
+class _Family:
+    """Latency histogram, error counter and in-flight gauge sharing one set of labels."""
+
+    def __init__(self, prefix, help, labels):
+        self.prefix = prefix
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def get(self, values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = _Series()
+        return series
+
+    def render(self, out):
+        p = self.prefix
+        out.append(f"# HELP {p}_seconds {self.help}")
+        out.append(f"# TYPE {p}_seconds histogram")
+        for values, s in self.series.items():
+            labels = _labels(self.labels, values)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, s.buckets):
+                cumulative += n
+                out.append(f'{p}_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            out.append(f'{p}_seconds_bucket{{{labels},le="+Inf"}} {s.count}')
+            out.append(f"{p}_seconds_sum{{{labels}}} {s.sum}")
+            out.append(f"{p}_seconds_count{{{labels}}} {s.count}")
+        out.append(f"# TYPE {p}_errors_total counter")
+        out.extend(f"{p}_errors_total{{{_labels(self.labels, v)}}} {s.errors}" for v, s in self.series.items())
+        out.append(f"# TYPE {p}_in_flight gauge")
+        out.extend(f"{p}_in_flight{{{_labels(self.labels, v)}}} {s.in_flight}" for v, s in self.series.items())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    return ",".join(f'{k}="{_escape(v)}"' for k, v in zip(names, values))
+
+
+class Metrics:
+    """Process-wide latency, error and in-flight metrics in Prometheus text format.
+
+    Three families are recorded: bot_handler (per handler, "/register" for
+    commands), bot_db (backend and operation: SQLite calls through
+    storage.Database, MongoDB commands through mongo.connect's listener)
+    and bot_api (Bot API method, timed without the rate limiter's queueing).
+    Collectors add the stats() of caches and queues as gauges. Updates come
+    from the event loop and from driver threads, hence the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.families = {
+            "handler": _Family("bot_handler", "Time spent in a handler callback.", ("handler",)),
+            "db": _Family("bot_db", "Duration of a database call.", ("backend", "operation")),
+            "bot_api": _Family("bot_api", "Duration of a Bot API request.", ("method",)),
+        }
+        self._collectors = {}
+        self._server = None
+
+    def start(self, kind, labels):
+        with self._lock:
+            self.families[kind].get(labels).in_flight += 1
+
+    def finish(self, kind, labels, seconds, error=False):
+        with self._lock:
+            series = self.families[kind].get(labels)
+            series.in_flight -= 1
+            series.count += 1
+            series.sum += seconds
+            if error:
+                series.errors += 1
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series.buckets[i] += 1
+                    break
+
+    @contextmanager
+    def track(self, kind, labels):
+        """Time the with-block; an exception escaping it counts as an error."""
+        self.start(kind, labels)
+        started = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.finish(kind, labels, time.perf_counter() - started, error)
+
+    def add_collector(self, name, stats):
+        """Export the numeric values of stats() as bot_<name>_<key> gauges on every scrape."""
+        self._collectors[name] = stats
+
+    def render(self):
+        out = []
+        with self._lock:
+            for family in self.families.values():
+                family.render(out)
+        for name, stats in list(self._collectors.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                # stats() runs on this thread while the bot mutates its state; skip this scrape
+                logger.warning("Metrics collector %s failed: %s", name, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    out.append(f"# TYPE bot_{name}_{key} gauge")
+                    out.append(f"bot_{name}_{key} {value}")
+        return "\n".join(out) + "\n"
+
+    # --- Handlers ---
+
+    def wrap(self, label, callback):
+        if getattr(callback, "_metrics_label", None):
+            return callback
+
+        @functools.wraps(callback)
+        async def timed(update, context):
+            with self.track("handler", (label,)):
+                return await callback(update, context)
+        timed._metrics_label = label
+        return timed
+
+    def instrument(self, app):
+        """Wrap the callback of every handler added to app, including those inside ConversationHandlers."""
+        from telegram.ext import CommandHandler, ConversationHandler
+
+        def visit(handler):
+            if isinstance(handler, ConversationHandler):
+                for inner in (*handler.entry_points, *handler.fallbacks,
+                              *(h for hs in handler.states.values() for h in hs)):
+                    visit(inner)
+                return
+            if isinstance(handler, CommandHandler):
+                label = "/" + "|/".join(sorted(handler.commands))
+            else:
+                label = getattr(handler.callback, "__name__", type(handler).__name__)
+            handler.callback = self.wrap(label, handler.callback)
+
+        for handlers in app.handlers.values():
+            for handler in handlers:
+                visit(handler)
+        self.add_collector("updates", app.update_processor.stats)
+        if app.bot.rate_limiter is not None:
+            self.add_collector("outbound", app.bot.rate_limiter.stats)
+
+    # --- Endpoint ---
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve GET /metrics from a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+
+
+metrics = Metrics()
@@ -0,0 +1,151 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Ordered schema steps for registrations.db. Each step runs exactly once, in its
+# own transaction, and is recorded in schema_version. Append new steps to the
+# end of MIGRATIONS; never edit or reorder one that has shipped.
+
+
+def starts_at(edate, etime):
+    """Sortable 'YYYY-MM-DD HH:MM' key for an event date and time."""
+    try:
+        return datetime.strptime(f"{edate} {etime or '00:00'}", "%Y-%m-%d %H:%M").strftime("%Y-%m-%d %H:%M")
+    except (TypeError, ValueError):
+        return f"{edate} {etime or ''}".strip()
+
+
+def _create_base_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS events (
+                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT,
+                edate TEXT,
+                etime TEXT,
+                location_name TEXT,
+                level TEXT,
+                published INTEGER,
+                location_coordinates TEXT)''')
+
+    conn.execute('''CREATE TABLE IF NOT EXISTS registrations (
+                user_id INTEGER,
+                event_id INTEGER,
+                shortname TEXT,
+                drives INTEGER,
+                safety_equipment TEXT,
+                car_details TEXT,
+                consent_accepted BOOLEAN,
+                PRIMARY KEY (user_id, event_id),
+                FOREIGN KEY (event_id) REFERENCES events(event_id))''')
+
+
+def _registration_indexes(conn):
+    # Databases bootstrapped before migrations existed may already have this one
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_registrations_event ON registrations (event_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_registrations_user ON registrations (user_id)")
+
+
+def _unique_event_name(conn):
+    # Events are addressed by name everywhere, so older duplicates are renamed
+    # to "<name> #<event_id>" before the unique index can be built.
+    renamed = conn.execute('''UPDATE events SET name = name || ' #' || event_id
+                              WHERE event_id NOT IN (SELECT MIN(event_id) FROM events GROUP BY name)''').rowcount
+    if renamed:
+        logger.warning("Renamed %d duplicate event name(s) before adding unique index", renamed)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_events_name ON events (name)")
+
+
+def _event_starts_at(conn):
+    conn.execute("ALTER TABLE events ADD COLUMN starts_at TEXT")
+    rows = conn.execute("SELECT event_id, edate, etime FROM events").fetchall()
+    conn.executemany("UPDATE events SET starts_at = ? WHERE event_id = ?",
+                     [(starts_at(edate, etime), event_id) for event_id, edate, etime in rows])
+    conn.execute("DROP INDEX IF EXISTS idx_events_edate")
+    conn.execute("CREATE INDEX idx_events_starts_at ON events (starts_at)")
+
+
+def _data_versions(conn):
+    # Bumped on every write through repository.SQLiteRepository, so caches in
+    # other processes can tell their copy is stale
+    conn.execute("CREATE TABLE data_versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+
+def _profiles_table(conn):
+    # Profile fields used to be copied into every registration; keep the latest
+    # copy per user in profiles and rebuild registrations with the per-event
+    # fields only (the short name is asked for each event, so it stays).
+    # rowid is carried over because /participants pages on it.
+    conn.execute('''CREATE TABLE profiles (
+                user_id INTEGER PRIMARY KEY,
+                shortname TEXT,
+                drives INTEGER,
+                safety_equipment TEXT,
+                car_details TEXT)''')
+    conn.execute('''INSERT INTO profiles (user_id, shortname, drives, safety_equipment, car_details)
+                    SELECT user_id, shortname, drives, safety_equipment, car_details FROM registrations r
+                    WHERE rowid = (SELECT MAX(rowid) FROM registrations WHERE user_id = r.user_id)''')
+    conn.execute('''CREATE TABLE registrations_new (
+                user_id INTEGER,
+                event_id INTEGER,
+                shortname TEXT,
+                consent_accepted BOOLEAN,
+                PRIMARY KEY (user_id, event_id),
+                FOREIGN KEY (user_id) REFERENCES profiles(user_id),
+                FOREIGN KEY (event_id) REFERENCES events(event_id))''')
+    # The old table was created with foreign keys off, so it may still hold
+    # registrations for deleted events; the new one would reject them.
+    orphans = conn.execute('''SELECT COUNT(*) FROM registrations
+                              WHERE event_id NOT IN (SELECT event_id FROM events) OR event_id IS NULL''').fetchone()[0]
+    if orphans:
+        logger.warning("Dropping %d registration(s) for events that no longer exist", orphans)
+    conn.execute('''INSERT INTO registrations_new (rowid, user_id, event_id, shortname, consent_accepted)
+                    SELECT rowid, user_id, event_id, shortname, consent_accepted FROM registrations
+                    WHERE event_id IN (SELECT event_id FROM events)''')
+    conn.execute("DROP TABLE registrations")
+    conn.execute("ALTER TABLE registrations_new RENAME TO registrations")
+    conn.execute("CREATE INDEX idx_registrations_event ON registrations (event_id)")
+    conn.execute("CREATE INDEX idx_registrations_user ON registrations (user_id)")
+    profiles = conn.execute("SELECT COUNT(*) FROM profiles").fetchone()[0]
+    logger.info("Moved %d profile(s) out of registrations", profiles)
+
+
+MIGRATIONS = [
+    (1, "create events and registrations tables", _create_base_tables),
+    (2, "index registrations by event and user", _registration_indexes),
+    (3, "unique index on event name", _unique_event_name),
+    (4, "sortable, indexed events.starts_at", _event_starts_at),
+    (5, "data versions for cache invalidation", _data_versions),
+    (6, "profiles table, registrations keep per-event fields", _profiles_table),
+]
+
+
+def current_version(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, description TEXT, applied_at TEXT)")
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply all pending migrations and return the resulting schema version."""
+    version = current_version(conn)
+    conn.commit()
+    for step_version, description, step in MIGRATIONS:
+        if step_version <= version:
+            continue
+        # IMMEDIATE takes the write lock up front, so a second process starting
+        # at the same time waits here and then sees the step already applied.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if current_version(conn) >= step_version:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                         (step_version, description, datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.exception("Migration %d (%s) failed", step_version, description)
+            raise
+        logger.info("Applied migration %d: %s", step_version, description)
+        version = step_version
+    return version
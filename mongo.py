@@ -0,0 +1,118 @@
+import logging
+import os
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ASCENDING, IndexModel, ReturnDocument, monitoring
+from pymongo.errors import OperationFailure
+from metrics import metrics
+from slowlog import slowlog
+
+logger = logging.getLogger(__name__)
+
+# Pool and timeout settings shared by the Mongo-backed bots (serve2.py, serve2-.py).
+# Motor binds to the running event loop on first use, so creating the client at
+# import time is fine.
+
+
+class _CommandMonitor(monitoring.CommandListener):
+    # Called on Motor's driver threads; duration_micros is the server round trip.
+    # Commands are kept until they finish so slow ones can go to the slow log.
+    def __init__(self):
+        self.client = None  # the underlying pymongo client, for explain
+        self._running = {}
+
+    def started(self, event):
+        metrics.start("db", ("mongo", event.command_name))
+        self._running[event.request_id] = (event.database_name, event.command)
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event, error=True)
+
+    def _finish(self, event, error=False):
+        seconds = event.duration_micros / 1e6
+        metrics.finish("db", ("mongo", event.command_name), seconds, error)
+        database, command = self._running.pop(event.request_id, (None, None))
+        if command is not None and seconds >= slowlog.threshold:
+            slowlog.mongo(self.client, database, event.command_name, command, seconds)
+
+
+def connect(uri, **kwargs):
+    options = {
+        "maxPoolSize": int(os.getenv("MONGO_MAX_POOL_SIZE", "50")),
+        "minPoolSize": int(os.getenv("MONGO_MIN_POOL_SIZE", "0")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "connectTimeoutMS": int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000")),
+        "socketTimeoutMS": int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000")),
+        "waitQueueTimeoutMS": int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "5000")),
+    }
+    monitor = _CommandMonitor()
+    options["event_listeners"] = [monitor]
+    options.update(kwargs)
+    client = AsyncIOMotorClient(uri, **options)
+    monitor.client = client.delegate
+    return client
+
+
+# --- Sequences ---
+# Integer IDs come from one document per sequence in the counters collection;
+# $inc on a single document is atomic, so concurrent publishers never share an ID.
+
+async def next_sequence(db, name):
+    doc = await db["counters"].find_one_and_update(
+        {"_id": name},
+        {"$inc": {"seq": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return doc["seq"]
+
+
+async def seed_sequence(db, name, collection, field):
+    """Make sure the sequence is at least the current maximum of collection.field.
+
+    $max never moves a counter backwards, so this is safe to run on every start.
+    """
+    last = await db[collection].find_one({field: {"$type": "number"}}, sort=[(field, -1)], projection={field: 1})
+    await db["counters"].update_one(
+        {"_id": name},
+        {"$max": {"seq": last[field] if last else 0}},
+        upsert=True
+    )
+
+
+# --- Indexes ---
+# Created on every start; create_index is a no-op when the index already exists.
+# The wider events indexes also carry the fields the list views project, so
+# those queries are answered from the index alone.
+INDEXES = {
+    "registrations": [
+        IndexModel([("event_id", ASCENDING), ("user_id", ASCENDING)], unique=True, name="event_user_unique"),
+        IndexModel([("user_id", ASCENDING), ("event_id", ASCENDING)], name="user_event"),
+        # Keyset pages of one event's registrations, in registration order
+        IndexModel([("event_id", ASCENDING), ("_id", ASCENDING)], name="event_id_order"),
+    ],
+    "events": [
+        IndexModel([("event_id", ASCENDING)], unique=True, name="event_id_unique"),
+        IndexModel([("published", ASCENDING), ("date", ASCENDING), ("event_id", ASCENDING), ("location", ASCENDING)],
+                   name="published_date"),
+        IndexModel([("date", ASCENDING), ("event_id", ASCENDING), ("location", ASCENDING)], name="date"),
+    ],
+    "users": [
+        IndexModel([("user_id", ASCENDING)], unique=True, name="user_id_unique"),
+    ],
+    "templates": [
+        IndexModel([("template_id", ASCENDING)], unique=True, name="template_id_unique"),
+    ],
+}
+
+
+async def ensure_indexes(db):
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as e:
+                # Typically duplicates blocking a unique index; the bot still works without it
+                logger.error("Could not create index %s on %s: %s", index.document["name"], collection, e)
@@ -0,0 +1,221 @@
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, passed per call as rate_limit_args={"priority": BULK}
+INTERACTIVE = 0
+BULK = 1
+
+# Telegram's per-chat limits count messages; reads (getChatMember, ...), edits
+# and callback answers only go through the global bucket
+CHAT_PACED_EXCLUDED = {"sendChatAction"}
+
+MAX_MESSAGE_LENGTH = 4096
+# sendMessage parameters that may differ between merged messages (only text does)
+MERGEABLE_KEYS = {"chat_id", "text", "parse_mode", "disable_notification", "protect_content",
+                  "message_thread_id", "disable_web_page_preview", "link_preview_options"}
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _Chat:
+    __slots__ = ("lock", "bucket", "pending_text", "last_used")
+
+    def __init__(self, bucket):
+        self.lock = asyncio.Lock()
+        self.bucket = bucket
+        self.pending_text = None  # (data, future) of a queued sendMessage others may merge into
+        self.last_used = time.monotonic()
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Paces every Bot API call against Telegram's flood limits.
+
+    Messages to one chat (send* endpoints) go out one at a time, in order,
+    through a per-chat token bucket (about 1/s in private chats, 20/min in
+    groups); every call, those included, then goes through one
+    global bucket (30/s) that serves INTERACTIVE calls before BULK ones. A
+    RetryAfter pauses all traffic for the requested time and the call is
+    retried. With merge_texts, a plain sendMessage still waiting for its turn
+    absorbs later plain texts to the same chat, and every caller gets the
+    merged Message back.
+    """
+
+    def __init__(self, global_rate=30.0, private_rate=1.0, private_burst=3, group_rate=20 / 60, group_burst=5,
+                 max_retries=3, merge_texts=False):
+        self.global_bucket = _TokenBucket(global_rate, global_rate)
+        self.private_rate, self.private_burst = private_rate, private_burst
+        self.group_rate, self.group_burst = group_rate, group_burst
+        self.max_retries = max_retries
+        self.merge_texts = merge_texts
+        self._chats = {}
+        self._lanes = None
+        self._seq = itertools.count()
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self.calls = 0
+        self.merged = 0
+        self.retry_after = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def initialize(self):
+        self._lanes = asyncio.PriorityQueue()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            # Awaited so the task is finished, not just flagged, when shutdown returns
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dispatcher
+            self._dispatcher = None
+
+    async def _dispatch(self):
+        # Hands out global tokens, highest-priority waiter first
+        while True:
+            _, _, grant = await self._lanes.get()
+            while True:
+                wait = max(self._paused_until - time.monotonic(), self.global_bucket.delay())
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.global_bucket.take()
+            if not grant.done():
+                grant.set_result(None)
+
+    async def _global_token(self, priority):
+        grant = asyncio.get_running_loop().create_future()
+        self._lanes.put_nowait((priority, next(self._seq), grant))
+        await grant
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > 10000:
+                self._prune()
+            group = isinstance(chat_id, str) or chat_id < 0
+            chat = self._chats[chat_id] = _Chat(
+                _TokenBucket(self.group_rate, self.group_burst) if group
+                else _TokenBucket(self.private_rate, self.private_burst))
+        chat.last_used = time.monotonic()
+        return chat
+
+    def _prune(self):
+        cutoff = time.monotonic() - 300
+        for chat_id in [c for c, s in self._chats.items() if s.last_used < cutoff and not s.lock.locked()]:
+            del self._chats[chat_id]
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = (rate_limit_args or {}).get("priority", INTERACTIVE)
+        chat_id = data.get("chat_id")
+        queued_at = time.monotonic()
+        if chat_id is None or not endpoint.startswith("send") or endpoint in CHAT_PACED_EXCLUDED:
+            await self._global_token(priority)
+            self._record_wait(queued_at)
+            return await self._call(callback, args, kwargs, endpoint, priority)
+
+        chat = self._chat(chat_id)
+        if self.merge_texts and endpoint == "sendMessage" and MERGEABLE_KEYS.issuperset(data):
+            merged = self._merge(chat, data)
+            if merged is not None:
+                return await merged
+            result = asyncio.get_running_loop().create_future()
+            chat.pending_text = (data, result)
+        else:
+            # Later texts must not jump ahead of this call by merging into an earlier one
+            chat.pending_text = None
+            result = None
+
+        try:
+            async with chat.lock:
+                while (wait := chat.bucket.delay()) > 0:
+                    await asyncio.sleep(wait)
+                chat.bucket.take()
+                await self._global_token(priority)
+                if chat.pending_text and chat.pending_text[1] is result:
+                    chat.pending_text = None  # text is final from here on
+                self._record_wait(queued_at)
+                response = await self._call(callback, args, kwargs, endpoint, priority)
+        except BaseException as e:
+            if result is not None and not result.done():
+                if isinstance(e, asyncio.CancelledError):
+                    result.cancel()
+                else:
+                    result.set_exception(e)
+                    result.exception()  # mark retrieved when nobody merged in
+            if chat.pending_text and chat.pending_text[1] is result:
+                chat.pending_text = None
+            raise
+        if result is not None:
+            result.set_result(response)
+        return response
+
+    def _merge(self, chat, data):
+        if not chat.pending_text:
+            return None
+        pending, result = chat.pending_text
+        if any(pending.get(k) != data.get(k) for k in MERGEABLE_KEYS - {"text"}):
+            return None
+        text = f"{pending['text']}\n\n{data['text']}"
+        if len(text) > MAX_MESSAGE_LENGTH:
+            return None
+        pending["text"] = text
+        self.merged += 1
+        return asyncio.shield(result)
+
+    async def _call(self, callback, args, kwargs, endpoint, priority):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.calls += 1
+                with metrics.track("bot_api", (endpoint,)):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Flood limit hit, pausing outbound calls for %.1fs", delay)
+                await self._global_token(priority)
+
+    def _record_wait(self, queued_at):
+        wait = time.monotonic() - queued_at
+        self.waits += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "merged": self.merged,
+            "retry_after": self.retry_after,
+            "queued": self._lanes.qsize() if self._lanes else 0,
+            "avg_wait": self.wait_total / self.waits if self.waits else 0.0,
+            "max_wait": self.wait_max,
+        }
@@ -0,0 +1,116 @@
+import glob
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+# Telegram limits for send_poll
+MIN_POLL_OPTIONS = 2
+MAX_POLL_OPTIONS = 10
+MAX_OPTION_LENGTH = 100
+
+OTHER = "Other"
+
+
+@dataclass(frozen=True)
+class Question:
+    text: str
+    kind: str                 # "text" or "poll"
+    options: tuple = ()
+    allow_text: bool = False  # last option is "Other" and asks for a typed answer
+    is_date: bool = False
+
+    @property
+    def option_count(self):
+        return len(self.options)
+
+    @property
+    def other_index(self):
+        return len(self.options) - 1 if self.allow_text else None
+
+
+def _compile_question(raw, references, source):
+    text = raw.get("question")
+    if not isinstance(text, str) or not text:
+        raise ValueError(f"{source}: question without text: {raw!r}")
+    if raw.get("type") == "text":
+        return Question(text=text, kind="text")
+    if raw.get("reference"):
+        if raw["reference"] not in references:
+            raise ValueError(f"{source}: {text!r} references unknown options file questions_{raw['reference']}.json")
+        options = list(references[raw["reference"]])
+    else:
+        options = list(raw.get("options") or ())
+    allow_text = bool(raw.get("allow_text"))
+    if allow_text and (not options or options[-1] != OTHER):
+        options.append(OTHER)
+    if not MIN_POLL_OPTIONS <= len(options) <= MAX_POLL_OPTIONS:
+        raise ValueError(f"{source}: {text!r} has {len(options)} options, polls allow {MIN_POLL_OPTIONS}-{MAX_POLL_OPTIONS}")
+    for option in options:
+        if not isinstance(option, str) or not 0 < len(option) <= MAX_OPTION_LENGTH:
+            raise ValueError(f"{source}: {text!r} has an invalid option {option!r}")
+    return Question(text=text, kind="poll", options=tuple(options), allow_text=allow_text,
+                    is_date=bool(raw.get("isDate")))
+
+
+class QuestionnaireRegistry:
+    """All questions_*.json files, loaded, validated and compiled once.
+
+    A file holding a list is a questionnaire (questions_drive.json -> "drive");
+    a file holding {"options": [...]} is a reference list other questions can
+    pull their options from. Files are re-stat'ed at most every check_interval
+    seconds and everything is recompiled when one changed; a broken edit is
+    logged and the previous definitions stay in use.
+    """
+
+    def __init__(self, directory=".", check_interval=5.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._questionnaires = {}
+        self._mtimes = None
+        self._checked_at = time.monotonic()
+        self._reload(self._scan())
+
+    def _scan(self):
+        pattern = os.path.join(self.directory, "questions_*.json")
+        return {path: os.stat(path).st_mtime_ns for path in glob.glob(pattern)}
+
+    def _reload(self, mtimes):
+        raw = {}
+        for path in mtimes:
+            name = os.path.basename(path)[len("questions_"):-len(".json")]
+            with open(path, "r", encoding="utf-8") as f:
+                raw[name] = json.load(f)
+        references = {name: data["options"] for name, data in raw.items()
+                      if isinstance(data, dict) and "options" in data}
+        questionnaires = {name: tuple(_compile_question(q, references, f"questions_{name}.json") for q in data)
+                          for name, data in raw.items() if isinstance(data, list)}
+        self._questionnaires = questionnaires
+        self._mtimes = mtimes
+        logger.info("Loaded questionnaires: %s", ", ".join(f"{n} ({len(q)})" for n, q in questionnaires.items()))
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtimes = self._scan()
+        except OSError as e:
+            logger.error("Could not check questionnaire files: %s", e)
+            return
+        if mtimes == self._mtimes:
+            return
+        try:
+            self._reload(mtimes)
+        except (OSError, ValueError) as e:
+            # json.JSONDecodeError is a ValueError too. Not retried until the files change again.
+            self._mtimes = mtimes
+            logger.error("Keeping previous questionnaires, reload failed: %s", e)
+
+    def get(self, name):
+        self._maybe_reload()
+        return self._questionnaires[name]
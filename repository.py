@@ -0,0 +1,508 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+import migrations
+
+logger = logging.getLogger(__name__)
+
+# Data kinds with a version counter; every write to one of them bumps it
+EVENTS = "events"
+PROFILES = "profiles"
+
+
+class Repository(ABC):
+    """Events, registrations and profiles, whatever the backend.
+
+    Records are plain dicts using the field names of the MongoDB documents:
+    events have event_id, name, date, time, location, coordinates, min_level
+    and published; profiles have user_id, screen_name, car, drives and
+    safety_equipment. Writes bump the version of the data kind they touch
+    and report it to on_write, which CachedRepository uses to keep its copy
+    in step. touch() does the same for writes made outside the repository.
+    """
+
+    on_write = None  # callable(kind, new_version), set by CachedRepository
+
+    def _written(self, kind, version):
+        if self.on_write is not None:
+            self.on_write(kind, version)
+
+    @abstractmethod
+    async def version(self, kind):
+        ...
+
+    @abstractmethod
+    async def touch(self, kind):
+        ...
+
+    # --- Events ---
+
+    @abstractmethod
+    async def all_events(self):
+        ...
+
+    @abstractmethod
+    async def get_event(self, event_id):
+        ...
+
+    @abstractmethod
+    async def find_event(self, name):
+        ...
+
+    async def list_events(self, since=None, published_only=False, fields=None):
+        """Events on or after the date since, in date order.
+
+        fields names the keys the caller needs (event_id is always included);
+        backends may use it to serve the query from an index and return more.
+        This default filters all_events(); the backends override it with an
+        indexed query.
+        """
+        events = [e for e in await self.all_events()
+                  if (since is None or (e.get("date") or "") >= since) and (not published_only or e.get("published"))]
+        return sorted(events, key=lambda e: (e.get("date") or "", e.get("time") or "", e["event_id"]))
+
+    @abstractmethod
+    async def add_event(self, fields):
+        """Store a new event and return it with its event_id."""
+
+    # --- Profiles ---
+
+    @abstractmethod
+    async def get_profile(self, user_id):
+        ...
+
+    @abstractmethod
+    async def add_profile(self, user_id, fields):
+        """Create the profile unless the user already has one; returns whether it was created."""
+
+    # --- Registrations ---
+
+    @abstractmethod
+    async def is_registered(self, event_id, user_id):
+        ...
+
+    @abstractmethod
+    async def add_registration(self, event_id, user_id, fields=None):
+        ...
+
+    @abstractmethod
+    async def remove_registration(self, event_id, user_id):
+        ...
+
+    @abstractmethod
+    async def registrants(self, event_id):
+        """user_ids registered for the event, in registration order."""
+
+
+class TemplateStore(ABC):
+    """Saved event templates; only the MongoDB backend has them."""
+
+    @abstractmethod
+    async def get_template(self, template_id):
+        ...
+
+    @abstractmethod
+    async def add_template(self, fields):
+        """Store a template and return its template_id."""
+
+
+# --- SQLite (event_serve) ---
+
+EVENT_COLUMNS = "event_id, name, edate, etime, location_name, location_coordinates, level, published"
+PROFILE_COLUMNS = "user_id, shortname, car_details, drives, safety_equipment"
+
+
+def _event(row):
+    if row is None:
+        return None
+    event_id, name, edate, etime, location_name, coordinates, level, published = row
+    return {"event_id": event_id, "name": name, "date": edate, "time": etime, "location": location_name,
+            "coordinates": coordinates, "min_level": level, "published": bool(published)}
+
+
+def _profile(row):
+    if row is None:
+        return None
+    user_id, shortname, car_details, drives, safety_equipment = row
+    return {"user_id": user_id, "screen_name": shortname, "car": car_details, "drives": drives,
+            "safety_equipment": safety_equipment}
+
+
+def _bump(conn, kind):
+    conn.execute("INSERT INTO data_versions (name, version) VALUES (?, 1) "
+                 "ON CONFLICT (name) DO UPDATE SET version = version + 1", (kind,))
+    return conn.execute("SELECT version FROM data_versions WHERE name = ?", (kind,)).fetchone()[0]
+
+
+def _touch(conn, kind):
+    with conn:
+        return _bump(conn, kind)
+
+
+def _write(conn, kind, sql, params):
+    # The statement and its version bump commit together
+    with conn:
+        cur = conn.execute(sql, params)
+        return cur.rowcount, cur.lastrowid, _bump(conn, kind)
+
+
+def _register(conn, event_id, user_id, profile, shortname, consent_accepted):
+    # Profile upsert, registration and version bump in one transaction
+    with conn:
+        if profile is not None:
+            conn.execute("INSERT INTO profiles (user_id, shortname, drives, safety_equipment, car_details) "
+                         "VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET shortname = excluded.shortname, "
+                         "drives = excluded.drives, safety_equipment = excluded.safety_equipment, "
+                         "car_details = excluded.car_details", (user_id, *profile))
+        # An update keeps the registration's rowid, and with it its place in /participants
+        conn.execute("INSERT INTO registrations (user_id, event_id, shortname, consent_accepted) VALUES (?, ?, ?, ?) "
+                     "ON CONFLICT (user_id, event_id) DO UPDATE SET shortname = excluded.shortname, "
+                     "consent_accepted = excluded.consent_accepted",
+                     (user_id, event_id, shortname, consent_accepted))
+        return _bump(conn, PROFILES) if profile is not None else None
+
+
+class SQLiteRepository(Repository):
+    """Repository over event_serve's tables, through a storage.Database.
+
+    Registering with profile fields also creates or updates the user's
+    profile, in the same transaction. screen_name is kept on the registration
+    as well: event_serve asks for a short name per event.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    async def _write(self, kind, sql, params):
+        rowcount, lastrowid, version = await self.db.run(_write, kind, sql, params)
+        self._written(kind, version)
+        return rowcount, lastrowid
+
+    async def version(self, kind):
+        row = await self.db.fetchone("SELECT version FROM data_versions WHERE name = ?", (kind,))
+        return row[0] if row else 0
+
+    async def touch(self, kind):
+        self._written(kind, await self.db.run(_touch, kind))
+
+    async def all_events(self):
+        return [_event(row) for row in await self.db.fetchall(f"SELECT {EVENT_COLUMNS} FROM events ORDER BY starts_at")]
+
+    async def get_event(self, event_id):
+        return _event(await self.db.fetchone(f"SELECT {EVENT_COLUMNS} FROM events WHERE event_id = ?", (event_id,)))
+
+    async def list_events(self, since=None, published_only=False, fields=None):
+        # Range scan on the starts_at index ('YYYY-MM-DD HH:MM' sorts after the bare date)
+        where, params = ["1"], []
+        if since is not None:
+            where.append("starts_at >= ?")
+            params.append(since)
+        if published_only:
+            where.append("published")
+        rows = await self.db.fetchall(f"SELECT {EVENT_COLUMNS} FROM events WHERE {' AND '.join(where)} "
+                                      "ORDER BY starts_at, event_id", params)
+        return [_event(row) for row in rows]
+
+    async def find_event(self, name):
+        return _event(await self.db.fetchone(f"SELECT {EVENT_COLUMNS} FROM events WHERE name = ?", (name,)))
+
+    async def add_event(self, fields):
+        # sqlite3.IntegrityError when the name is taken (unique index)
+        _, event_id = await self._write(
+            EVENTS,
+            "INSERT INTO events (name, edate, etime, starts_at, location_name, location_coordinates, level, published) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (fields.get("name"), fields.get("date"), fields.get("time"),
+             migrations.starts_at(fields.get("date"), fields.get("time")), fields.get("location"),
+             fields.get("coordinates"), fields.get("min_level"), fields.get("published")))
+        return await self.get_event(event_id)
+
+    async def get_profile(self, user_id):
+        return _profile(await self.db.fetchone(f"SELECT {PROFILE_COLUMNS} FROM profiles WHERE user_id = ?", (user_id,)))
+
+    async def add_profile(self, user_id, fields):
+        rowcount, _ = await self._write(
+            PROFILES,
+            "INSERT OR IGNORE INTO profiles (user_id, shortname, drives, safety_equipment, car_details) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (user_id, fields.get("screen_name"), fields.get("drives"), fields.get("safety_equipment"),
+             fields.get("car")))
+        return rowcount > 0
+
+    async def is_registered(self, event_id, user_id):
+        return await self.db.fetchone("SELECT 1 FROM registrations WHERE event_id = ? AND user_id = ?",
+                                      (event_id, user_id)) is not None
+
+    async def add_registration(self, event_id, user_id, fields=None):
+        # Profile fields among fields (screen_name, drives, ...) update the user's profile
+        fields = fields or {}
+        profile = None
+        if any(k in fields for k in ("screen_name", "drives", "safety_equipment", "car")):
+            profile = (fields.get("screen_name"), fields.get("drives"), fields.get("safety_equipment"),
+                       fields.get("car"))
+        version = await self.db.run(_register, event_id, user_id, profile, fields.get("screen_name"),
+                                    fields.get("consent_accepted", True))
+        if version is not None:
+            self._written(PROFILES, version)
+        return True
+
+    async def remove_registration(self, event_id, user_id):
+        rowcount, _ = await self.db.execute("DELETE FROM registrations WHERE event_id = ? AND user_id = ?",
+                                            (event_id, user_id))
+        return rowcount > 0
+
+    async def registrants(self, event_id):
+        rows = await self.db.fetchall("SELECT user_id FROM registrations WHERE event_id = ? ORDER BY rowid", (event_id,))
+        return [user_id for user_id, in rows]
+
+
+# --- MongoDB (serve2, serve2-) ---
+
+class MongoRepository(Repository, TemplateStore):
+    """Repository over the eventbot collections; versions live in the counters collection."""
+
+    def __init__(self, db):
+        # Imported here so event_serve can use this module without pymongo installed
+        import mongo
+        from pymongo.errors import DuplicateKeyError
+        self.db = db
+        self._mongo = mongo
+        self._duplicate = DuplicateKeyError
+
+    async def _bump(self, kind):
+        self._written(kind, await self._mongo.next_sequence(self.db, f"version:{kind}"))
+
+    async def version(self, kind):
+        doc = await self.db["counters"].find_one({"_id": f"version:{kind}"})
+        return doc["seq"] if doc else 0
+
+    async def touch(self, kind):
+        await self._bump(kind)
+
+    async def all_events(self):
+        return await self.db["events"].find({}, {"_id": 0}).to_list(length=None)
+
+    async def get_event(self, event_id):
+        return await self.db["events"].find_one({"event_id": event_id}, {"_id": 0})
+
+    async def list_events(self, since=None, published_only=False, fields=None):
+        # With published_only and fields drawn from the published_date index
+        # (see mongo.INDEXES) the query is covered
+        query = {}
+        if published_only:
+            query["published"] = True
+        if since is not None:
+            query["date"] = {"$gte": since}
+        projection = {"_id": 0, **({f: 1 for f in ("event_id", *fields)} if fields else {})}
+        return await self.db["events"].find(query, projection).sort([("date", 1), ("event_id", 1)]) \
+            .to_list(length=None)
+
+    async def find_event(self, name):
+        return await self.db["events"].find_one({"name": name}, {"_id": 0})
+
+    async def add_event(self, fields):
+        event = dict(fields, event_id=await self._mongo.next_sequence(self.db, "event_id"))
+        await self.db["events"].insert_one(event)
+        event.pop("_id", None)
+        await self._bump(EVENTS)
+        return event
+
+    async def get_profile(self, user_id):
+        return await self.db["users"].find_one({"user_id": user_id}, {"_id": 0})
+
+    async def add_profile(self, user_id, fields):
+        try:
+            await self.db["users"].insert_one(dict(fields, user_id=user_id))
+        except self._duplicate:
+            return False
+        await self._bump(PROFILES)
+        return True
+
+    async def is_registered(self, event_id, user_id):
+        return await self.db["registrations"].find_one({"event_id": event_id, "user_id": user_id},
+                                                       {"_id": 1}) is not None
+
+    async def add_registration(self, event_id, user_id, fields=None):
+        # Upsert on the unique (event_id, user_id) key, so a double tap never inserts twice
+        try:
+            result = await self.db["registrations"].update_one(
+                {"event_id": event_id, "user_id": user_id},
+                {"$setOnInsert": dict(fields or {}, registered_at=datetime.utcnow())},
+                upsert=True)
+        except self._duplicate:
+            return False
+        return result.upserted_id is not None
+
+    async def remove_registration(self, event_id, user_id):
+        result = await self.db["registrations"].delete_one({"event_id": event_id, "user_id": user_id})
+        return result.deleted_count > 0
+
+    async def registrants(self, event_id):
+        regs = await self.db["registrations"].find({"event_id": event_id}, {"_id": 0, "user_id": 1}) \
+            .sort("_id", 1).to_list(length=None)
+        return [r["user_id"] for r in regs]
+
+    async def get_template(self, template_id):
+        return await self.db["templates"].find_one({"template_id": template_id}, {"_id": 0})
+
+    async def add_template(self, fields):
+        template = dict(fields, template_id=await self._mongo.next_sequence(self.db, "template_id"))
+        await self.db["templates"].insert_one(template)
+        return template["template_id"]
+
+
+# --- Cache ---
+
+class CachedRepository(Repository):
+    """Write-through cache in front of another repository.
+
+    The whole (small, read-mostly) events set and up to profile_capacity
+    profiles (LRU, including "no profile") are kept in memory. Writes made
+    through this object update the cached copy. Every check_interval seconds
+    the stored version of each kind is compared with the one the copy was
+    built from, and a mismatch (another process wrote) drops the copy. A
+    load that overlapped a write or a drop (handlers run concurrently) is
+    returned to its caller but not kept.
+    Registrations are passed straight through; templates are not cached, use
+    the inner repository for them.
+    """
+
+    def __init__(self, inner, profile_capacity=1024, check_interval=5.0):
+        self.inner = inner
+        self.profile_capacity = profile_capacity
+        self.check_interval = check_interval
+        inner.on_write = self._on_write
+        self._events = None  # event_id -> event
+        self._profiles = OrderedDict()  # user_id -> profile or None
+        self._versions = {EVENTS: None, PROFILES: None}
+        self._checked = {EVENTS: 0.0, PROFILES: 0.0}
+        self._generation = {EVENTS: 0, PROFILES: 0}  # bumped whenever a kind is written or dropped
+        self.hits = 0
+        self.misses = 0
+
+    def _drop(self, kind):
+        self._generation[kind] += 1
+        if kind == EVENTS:
+            self._events = None
+        else:
+            self._profiles.clear()
+
+    def _on_write(self, kind, version):
+        # Our own write moved the version by one: the copy stays valid once the
+        # caller has applied the write to it. A bigger step means others wrote too.
+        if self._versions[kind] is not None and version == self._versions[kind] + 1:
+            self._generation[kind] += 1
+            self._versions[kind] = version
+        else:
+            self._drop(kind)
+            self._versions[kind] = version
+
+    async def _check(self, kind):
+        now = time.monotonic()
+        if now - self._checked[kind] < self.check_interval:
+            return
+        self._checked[kind] = now
+        version = await self.inner.version(kind)
+        if version != self._versions[kind]:
+            if self._versions[kind] is not None:
+                logger.debug("%s changed elsewhere (version %s -> %s), dropping cache", kind, self._versions[kind], version)
+            self._drop(kind)
+            self._versions[kind] = version
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "profiles": len(self._profiles),
+                "events": len(self._events) if self._events is not None else 0}
+
+    async def version(self, kind):
+        return await self.inner.version(kind)
+
+    async def touch(self, kind):
+        await self.inner.touch(kind)
+        self._drop(kind)
+
+    # --- Events ---
+
+    async def _event_map(self):
+        await self._check(EVENTS)
+        if self._events is not None:
+            self.hits += 1
+            return self._events
+        self.misses += 1
+        generation = self._generation[EVENTS]
+        events = {e["event_id"]: e for e in await self.inner.all_events()}
+        if self._generation[EVENTS] == generation:
+            self._events = events
+        return events
+
+    async def all_events(self):
+        return list((await self._event_map()).values())
+
+    async def list_events(self, since=None, published_only=False, fields=None):
+        # Filter the cached copy when there is one; otherwise the backend's indexed
+        # query is cheaper than loading every event to answer it
+        await self._check(EVENTS)
+        if self._events is not None:
+            return await super().list_events(since, published_only, fields)
+        self.misses += 1
+        return await self.inner.list_events(since, published_only, fields)
+
+    async def get_event(self, event_id):
+        return (await self._event_map()).get(event_id)
+
+    async def find_event(self, name):
+        return next((e for e in (await self._event_map()).values() if e.get("name") == name), None)
+
+    async def add_event(self, fields):
+        event = await self.inner.add_event(fields)
+        if self._events is not None:
+            self._events[event["event_id"]] = event
+        return event
+
+    # --- Profiles ---
+
+    async def get_profile(self, user_id):
+        await self._check(PROFILES)
+        if user_id in self._profiles:
+            self.hits += 1
+            self._profiles.move_to_end(user_id)
+            return self._profiles[user_id]
+        self.misses += 1
+        generation = self._generation[PROFILES]
+        profile = await self.inner.get_profile(user_id)
+        if self._generation[PROFILES] == generation:
+            self._remember(user_id, profile)
+        return profile
+
+    def _remember(self, user_id, profile):
+        self._profiles[user_id] = profile
+        self._profiles.move_to_end(user_id)
+        while len(self._profiles) > self.profile_capacity:
+            self._profiles.popitem(last=False)
+
+    def _forget(self, user_id):
+        self._generation[PROFILES] += 1
+        self._profiles.pop(user_id, None)
+
+    async def add_profile(self, user_id, fields):
+        created = await self.inner.add_profile(user_id, fields)
+        self._forget(user_id)  # re-read: on a duplicate the stored profile wins
+        return created
+
+    # --- Registrations ---
+
+    async def is_registered(self, event_id, user_id):
+        return await self.inner.is_registered(event_id, user_id)
+
+    async def add_registration(self, event_id, user_id, fields=None):
+        added = await self.inner.add_registration(event_id, user_id, fields)
+        if fields:
+            self._forget(user_id)  # SQLite updates the profile from fields
+        return added
+
+    async def remove_registration(self, event_id, user_id):
+        return await self.inner.remove_registration(event_id, user_id)
+
+    async def registrants(self, event_id):
+        return await self.inner.registrants(event_id)
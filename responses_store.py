@@ -0,0 +1,185 @@
+import csv
+import glob
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+LEGACY_MARKER = ".legacy_imported"
+
+
+class ResponseStore:
+    """Confirmed questionnaire responses in rotating JSONL files.
+
+    append() hands a record to a background writer thread and returns a
+    Future that resolves once the record is on disk. The writer drains
+    everything queued since its last pass, writes it in one go and fsyncs
+    once per batch, so a burst of confirmations shares a single fsync.
+    Files are responses-00001.jsonl, responses-00002.jsonl, ... and a new
+    one is started once the current file exceeds max_bytes.
+    """
+
+    def __init__(self, directory="responses", max_bytes=16 * 1024 * 1024, max_batch=500):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+
+    # --- Writing ---
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="responses-writer", daemon=True)
+            self._thread.start()
+
+    def append(self, record):
+        future = Future()
+        self.start()
+        self._queue.put((json.dumps(record, ensure_ascii=False), future))
+        return future
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _files(self):
+        return sorted(glob.glob(os.path.join(self.directory, "responses-*.jsonl")))
+
+    def _open_current(self):
+        files = self._files()
+        path = files[-1] if files else os.path.join(self.directory, "responses-00001.jsonl")
+        if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+            path = self._next_path(path)
+        return open(path, "a", encoding="utf-8")
+
+    @staticmethod
+    def _next_path(path):
+        number = int(os.path.basename(path)[len("responses-"):-len(".jsonl")])
+        return os.path.join(os.path.dirname(path), f"responses-{number + 1:05d}.jsonl")
+
+    def _run(self):
+        f = self._open_current()
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self._queue.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stopping = True
+                    batch = [item for item in batch if item is not None]
+                if not batch:
+                    continue
+                try:
+                    f.write("".join(line + "\n" for line, _ in batch))
+                    f.flush()
+                    os.fsync(f.fileno())
+                except Exception as e:
+                    # Any failure, not just OSError: the thread must survive or every
+                    # later append() would wait forever
+                    logger.exception("Writing %d response(s) failed", len(batch))
+                    for _, future in batch:
+                        future.set_exception(e)
+                    continue
+                for _, future in batch:
+                    future.set_result(None)
+                if f.tell() >= self.max_bytes:
+                    try:
+                        rotated = open(self._next_path(f.name), "a", encoding="utf-8")
+                    except Exception:
+                        logger.exception("Could not start a new responses file; still writing to %s", f.name)
+                    else:
+                        f.close()
+                        f = rotated
+        finally:
+            f.close()
+
+    # --- Reading ---
+
+    def query(self, user_id=None, since=None, until=None):
+        """Yield stored records, oldest first, optionally filtered by user and timestamp range."""
+        for path in self._files():
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if user_id is not None and record.get("user_id") != user_id:
+                        continue
+                    if since is not None and record.get("timestamp", "") < since:
+                        continue
+                    if until is not None and record.get("timestamp", "") >= until:
+                        continue
+                    yield record
+
+    def export(self, out, fmt="jsonl", **filters):
+        """Write matching records to the open file out as JSON lines or CSV; returns the count."""
+        count = 0
+        writer = None
+        for record in self.query(**filters):
+            if fmt == "csv":
+                if writer is None:
+                    writer = csv.writer(out)
+                    writer.writerow(["user_id", "timestamp", "answers"])
+                writer.writerow([record.get("user_id"), record.get("timestamp"), " | ".join(map(str, record.get("answers", [])))])
+            else:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        return count
+
+    # --- Migration ---
+
+    def import_legacy(self, directory=None):
+        """One-time import of the old per-confirmation {user_id}_{timestamp}.json files.
+
+        Returns the number of records imported; 0 once the import has run.
+        The legacy files are left in place.
+        """
+        directory = directory or self.directory
+        marker = os.path.join(self.directory, LEGACY_MARKER)
+        if os.path.exists(marker):
+            return 0
+        records = []
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning("Skipping unreadable response file %s: %s", path, e)
+        records.sort(key=lambda r: r.get("timestamp", ""))
+        futures = [self.append(record) for record in records]
+        for future in futures:
+            future.result()
+        with open(marker, "w") as f:
+            f.write(f"{len(records)}\n")
+        logger.info("Imported %d legacy response file(s) from %s", len(records), directory)
+        return len(records)
+
+
+if __name__ == "__main__":
+    # python responses_store.py import [legacy_dir]
+    # python responses_store.py export [jsonl|csv] [user_id]
+    logging.basicConfig(level=logging.INFO)
+    store = ResponseStore(os.getenv("RESPONSES_DIR", "responses"))
+    command = sys.argv[1] if len(sys.argv) > 1 else "export"
+    if command == "import":
+        store.import_legacy(sys.argv[2] if len(sys.argv) > 2 else None)
+        store.close()
+    elif command == "export":
+        fmt = sys.argv[2] if len(sys.argv) > 2 else "jsonl"
+        user_id = int(sys.argv[3]) if len(sys.argv) > 3 else None
+        store.export(sys.stdout, fmt=fmt, user_id=user_id)
+    else:
+        sys.exit(f"Unknown command {command!r}; use 'import' or 'export'.")
@@ -0,0 +1,74 @@
+import logging
+import os
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from update_processor import KeyedUpdateProcessor
+from outbound import OutboundLimiter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Settings below may come from .env for every bot, including those that never load it themselves
+load_dotenv()
+
+
+def builder(token):
+    """ApplicationBuilder shared by all bots.
+
+    Updates are handled concurrently by up to BOT_WORKERS tasks, but in order
+    per user (see KeyedUpdateProcessor); app.update_processor.stats() reports
+    queue depth and wait times. Outbound Bot API calls are paced by
+    OutboundLimiter (app.bot.rate_limiter.stats() for queue latency).
+    BOT_API_BASE_URL points the bot at another Bot API server, e.g. a local
+    one or loadtest.py's stand-in ("http://127.0.0.1:8081/bot").
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(KeyedUpdateProcessor(int(os.getenv("BOT_WORKERS", "16"))))
+        .rate_limiter(OutboundLimiter(merge_texts=os.getenv("OUTBOUND_MERGE_TEXTS", "0") == "1"))
+    )
+    base_url = os.getenv("BOT_API_BASE_URL")
+    if base_url:
+        builder = builder.base_url(base_url)
+    return builder
+
+
+def run(app):
+    """Run the bot with long polling, or as a webhook server when BOT_MODE=webhook.
+
+    Webhook mode uses python-telegram-bot's embedded server, which only accepts
+    requests carrying the configured secret token and feeds them into app.
+    Several instances can sit behind one load balancer as long as they share
+    WEBHOOK_URL/WEBHOOK_PATH/WEBHOOK_SECRET.
+
+    With METRICS_PORT set, handler, database and Bot API latencies are
+    served in Prometheus format on 127.0.0.1:METRICS_PORT/metrics.
+    """
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics.instrument(app)
+        metrics.serve(int(metrics_port), os.getenv("METRICS_LISTEN", "127.0.0.1"))
+    mode = os.getenv("BOT_MODE", "polling").lower()
+    if mode == "webhook":
+        public_url = os.getenv("WEBHOOK_URL")
+        secret = os.getenv("WEBHOOK_SECRET")
+        if not public_url or not secret:
+            raise RuntimeError("BOT_MODE=webhook needs WEBHOOK_URL and WEBHOOK_SECRET.")
+        listen = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+        port = int(os.getenv("WEBHOOK_PORT", "8443"))
+        url_path = os.getenv("WEBHOOK_PATH", "telegram").strip("/")
+        logger.info("Serving webhook on %s:%d/%s", listen, port, url_path)
+        app.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=url_path,
+            webhook_url=f"{public_url.rstrip('/')}/{url_path}",
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    elif mode == "polling":
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        raise RuntimeError(f"Unknown BOT_MODE {mode!r}; use 'polling' or 'webhook'.")
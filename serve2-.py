@@ -4,9 +4,13 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler, ConversationHandler,
     MessageHandler, ContextTypes, filters
 )
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from datetime import datetime
 import os
+from admin_cache import admin_cache
+import mongo
+from repository import EVENTS, PROFILES, CachedRepository, MongoRepository
+import runner
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,12 +20,16 @@ MONGO_URI = os.getenv('MONGO_URI','')
 
 # --- MongoDB Setup ---
 #MONGO_URI = "YOUR_MONGODB_URI"
-client = MongoClient(MONGO_URI)
+client = mongo.connect(MONGO_URI)
 db = client['eventbot']
 users_col = db['users']
 events_col = db['events']
 registrations_col = db['registrations']
-templates_col = db['templates']
+
+# Events, profiles, registrations and templates go through the repository shared
+# with serve2, so both bots bump the same version counters (see repository.py)
+store = MongoRepository(db)
+repo = CachedRepository(store)
 
 # --- States ---
 (ASK_DATE, ASK_LOCATION, ASK_LEVEL, ASK_PUBLISH,
@@ -29,16 +37,50 @@ templates_col = db['templates']
 
 # --- Helpers ---
 async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    member = await update.effective_chat.get_member(update.effective_user.id)
-    return member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+    return await admin_cache.is_admin(context.bot, update.effective_chat.id, update.effective_user.id)
+
+async def on_startup(app):
+    await mongo.ensure_indexes(db)
+    # Start the counters where the existing data left off
+    await mongo.seed_sequence(db, "event_id", "events", "event_id")
+    await mongo.seed_sequence(db, "template_id", "templates", "template_id")
+    await seed_registration_order()
 
-def get_next_event_id():
-    last = events_col.find_one(sort=[("event_id", -1)])
-    return (last["event_id"] + 1) if last else 1
+async def seed_registration_order():
+    # Events created before the per-event counter existed continue from their highest order
+    event_ids = await events_col.distinct("event_id", {"registration_seq": {"$exists": False}})
+    if not event_ids:
+        return
+    last_orders = {}
+    async for row in registrations_col.aggregate([
+        {"$match": {"event_id": {"$in": event_ids}}},
+        {"$group": {"_id": "$event_id", "last": {"$max": "$order"}}}
+    ]):
+        last_orders[row["_id"]] = row["last"] or 0
+    for event_id in event_ids:
+        await events_col.update_one({"event_id": event_id}, {"$max": {"registration_seq": last_orders.get(event_id, 0)}})
+
+async def next_registration_order(event_id):
+    # Atomic per-event counter on the event document: one round trip, and taps
+    # arriving together still get distinct first-come-first-served numbers.
+    # registration_seq is internal bookkeeping no cached view shows, so this
+    # write does not bump the events version.
+    event = await events_col.find_one_and_update(
+        {"event_id": event_id},
+        {"$inc": {"registration_seq": 1}},
+        projection={"_id": 0, "registration_seq": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    return event["registration_seq"] if event else None
 
-def get_next_template_id():
-    last = templates_col.find_one(sort=[("template_id", -1)])
-    return (last["template_id"] + 1) if last else 1
+async def add_registration(event_id, user_id):
+    order = await next_registration_order(event_id)
+    if order is None:
+        return None
+    if not await repo.add_registration(event_id, user_id, {"order": order}):
+        # Lost a double-tap race; the unique (event_id, user_id) index kept one registration
+        return None
+    return order
 
 # --- Event Creation ---
 async def create_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -78,9 +120,9 @@ async def publish_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     event = context.user_data.pop('event')
-    event_id = get_next_event_id()
-    event['event_id'] = event_id
-    events_col.insert_one(event)
+    event['registration_seq'] = 0
+    event = await repo.add_event(event)
+    event_id = event['event_id']
     # Post event with registration button
     keyboard = [[InlineKeyboardButton("Register", callback_data=f"register|{event_id}")]]
     await query.edit_message_text(
@@ -100,8 +142,7 @@ async def store_template(update: Update, context: ContextTypes.DEFAULT_TYPE):
     template_name = update.message.text
     template = context.user_data.get('event', {})
     template['template_name'] = template_name
-    template['template_id'] = get_next_template_id()
-    templates_col.insert_one(template)
+    await store.add_template(template)  # templates are not cached
     await update.message.reply_text(f"Template '{template_name}' saved.")
     context.user_data.pop('event', None)
     return ConversationHandler.END
@@ -120,24 +161,18 @@ async def register_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     _, event_id = query.data.split("|")
     event_id = int(event_id)
-    user = users_col.find_one({"user_id": user_id})
-    if not user:
+    if await repo.get_profile(user_id) is None:
         context.user_data['register_event_id'] = event_id
         await query.message.reply_text("Let's create your profile!\nEnter your screen name:")
         return ASK_SCREEN
     # Check if already registered
-    reg = registrations_col.find_one({"event_id": event_id, "user_id": user_id})
-    if reg:
+    if await repo.is_registered(event_id, user_id):
         await query.message.reply_text("You are already registered.")
         return ConversationHandler.END
     # Register
-    order = registrations_col.count_documents({"event_id": event_id}) + 1
-    registrations_col.insert_one({
-        "event_id": event_id,
-        "user_id": user_id,
-        "registered_at": datetime.utcnow(),
-        "order": order
-    })
+    if await add_registration(event_id, user_id) is None:
+        await query.message.reply_text("Could not register: the event no longer exists or you are already registered.")
+        return ConversationHandler.END
     await query.message.reply_text("You are registered for the event!")
     return ConversationHandler.END
 
@@ -155,22 +190,17 @@ async def ask_drives(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def save_profile_and_register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     profile = context.user_data.pop('profile')
-    profile['user_id'] = user_id
     profile['drives'] = int(update.message.text)
-    users_col.insert_one(profile)
+    await repo.add_profile(user_id, profile)
     event_id = context.user_data.pop('register_event_id')
-    order = registrations_col.count_documents({"event_id": event_id}) + 1
-    registrations_col.insert_one({
-        "event_id": event_id,
-        "user_id": user_id,
-        "registered_at": datetime.utcnow(),
-        "order": order
-    })
+    if await add_registration(event_id, user_id) is None:
+        await update.message.reply_text("Profile created, but the event is no longer available.")
+        return
     await update.message.reply_text("Profile created and registered for the event!")
 
 # --- List Events ---
 async def list_events(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    events = list(events_col.find())
+    events = await repo.all_events()
     if not events:
         await update.message.reply_text("No events available.")
         return
@@ -189,14 +219,33 @@ async def start_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /start_event <event_id>")
         return
     event_id = int(args[0])
-    regs = registrations_col.find({"event_id": event_id})
-    for reg in regs:
-        users_col.update_one({"user_id": reg["user_id"]}, {"$inc": {"drives": 1}})
-    await update.message.reply_text("Event started and drive counts updated.")
+    # Flag the event first so running /start_event again cannot double-count;
+    # the flag is cleared again if counting fails
+    marked = await events_col.update_one(
+        {"event_id": event_id, "started": {"$ne": True}},
+        {"$set": {"started": True, "started_at": datetime.utcnow()}}
+    )
+    if not marked.matched_count:
+        if await events_col.count_documents({"event_id": event_id}, limit=1):
+            await update.message.reply_text("Event was already started; drive counts were not changed.")
+        else:
+            await update.message.reply_text("Event not found.")
+        return
+    try:
+        user_ids = await registrations_col.distinct("user_id", {"event_id": event_id})
+        result = await users_col.update_many({"user_id": {"$in": user_ids}}, {"$inc": {"drives": 1}})
+    except Exception:
+        # Release the marker so the admin can retry instead of being told it already started
+        await events_col.update_one({"event_id": event_id}, {"$unset": {"started": "", "started_at": ""}})
+        raise
+    # Both writes bypass the repository; bump the versions so cached copies are dropped
+    await repo.touch(EVENTS)
+    await repo.touch(PROFILES)
+    await update.message.reply_text(f"Event started and drive counts updated for {result.modified_count} participant(s).")
 
 # --- Main ---
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = runner.builder(BOT_TOKEN).post_init(on_startup).build()
 
     event_conv = ConversationHandler(
         entry_points=[CommandHandler("create_event", create_event)],
@@ -227,9 +276,10 @@ def main():
     app.add_handler(profile_conv)
     app.add_handler(CommandHandler("events", list_events))
     app.add_handler(CommandHandler("start_event", start_event))
+    app.add_handler(admin_cache.handler())
 
     print("Bot running...")
-    app.run_polling()
+    runner.run(app)
 
 if __name__ == "__main__":
     main()
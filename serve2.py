@@ -4,10 +4,17 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler, ConversationHandler,
     MessageHandler, ContextTypes, filters
 )
-from pymongo import MongoClient
+from bson import ObjectId
 from datetime import datetime
 import os
 from dotenv import load_dotenv
+from admin_cache import admin_cache
+from view_cache import ViewCache
+from metrics import metrics
+from repository import EVENTS, PROFILES, CachedRepository, MongoRepository
+from slowlog import slowlog
+import mongo
+import runner
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,12 +26,23 @@ MONGO_URI = os.getenv('MONGO_URI','')
 
 # --- MongoDB Setup ---
 #MONGO_URI = "YOUR_MONGODB_URI"
-client = MongoClient(MONGO_URI)
-db = client['eventbot']
+client = mongo.connect(MONGO_URI)
+db = client[os.getenv('MONGO_DB', 'eventbot')]
 users_col = db['users']
 events_col = db['events']
 registrations_col = db['registrations']
 
+# Rendered upcoming-events menu and event detail screens. Handlers that write
+# events or registrations invalidate the affected views; the TTL covers
+# writes made by other processes sharing the database.
+views = ViewCache(ttl=float(os.getenv('VIEW_CACHE_TTL', '300')))
+metrics.add_collector("view_cache", views.stats)
+
+# Events and profiles go through the repository, which keeps a write-through
+# copy of the events and recently seen profiles (see repository.py)
+repo = CachedRepository(MongoRepository(db))
+metrics.add_collector("repository", repo.stats)
+
 # --- States for ConversationHandler ---
 (ASK_DATE, ASK_LOCATION, ASK_LEVEL, ASK_PUBLISH,
  ASK_SCREEN, ASK_CAR, ASK_DRIVES) = range(7)
@@ -35,15 +53,21 @@ async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         #member = await update.effective_chat.get_member(update.effective_user.id)
         print(f"[DEBUG] chatid: {update.effective_chat} vs master {GROUPID}")
         #prepend - or -100 infront of supergroup chat id
-        member = await context.bot.get_chat_member(f"-{GROUPID}", update.effective_user.id)
-        return member.status in [ChatMember.ADMINISTRATOR, ChatMember.OWNER]
+        return await admin_cache.is_admin(context.bot, f"-{GROUPID}", update.effective_user.id)
     except Exception as e:
         print(e)
         return False
 
-def get_next_event_id():
-    last = events_col.find_one(sort=[("event_id", -1)])
-    return (last["event_id"] + 1) if last else 1
+async def has_profile(user_id):
+    return await repo.get_profile(user_id) is not None
+
+async def on_startup(app):
+    await mongo.ensure_indexes(db)
+    # Start the counters where the existing data left off
+    await mongo.seed_sequence(db, "event_id", "events", "event_id")
+
+# Fields the event list views render; all of them are in the events indexes (see mongo.INDEXES)
+LISTING_FIELDS = {"_id": 0, "event_id": 1, "date": 1, "location": 1}
 
 # --- Inline Keyboards ---
 def admin_menu():
@@ -78,8 +102,7 @@ def admin_event_buttons(event_id):
 # --- Start/Help ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user = users_col.find_one({"user_id": user_id})
-    if not user:
+    if not await has_profile(user_id):
         await update.message.reply_text(
             "Welcome! Let's create your profile.\n"
             "Please enter your screen name:"
@@ -106,7 +129,7 @@ async def save_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         profile['drives'] = int(update.message.text)
     except ValueError:
         profile['drives'] = 0
-    users_col.insert_one(profile)
+    await repo.add_profile(user_id, profile)  # False if created from another session
     await update.message.reply_text("Profile created! Use /menu to see event options.")
     return ConversationHandler.END
 
@@ -156,11 +179,11 @@ async def admin_publish_event(update: Update, context: ContextTypes.DEFAULT_TYPE
     query = update.callback_query
     await query.answer()
     event = context.user_data.pop('event')
-    event_id = get_next_event_id()
-    event['event_id'] = event_id
     event['published'] = True
     event['publish_date'] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-    events_col.insert_one(event)
+    event = await repo.add_event(event)
+    event_id = event['event_id']
+    views.invalidate_view("upcoming")
     await query.edit_message_text(
         f"Event #{event_id} published!\n"
         f"Date: {event['date']}\nLocation: {event['location']}\nMin Level: {event['min_level']}"
@@ -175,53 +198,129 @@ async def admin_cancel_event(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return ConversationHandler.END
 
 # --- Admin: List Events for Registration View ---
+# Both admin listings page with a keyset seek (the last key shown goes into
+# the Next button) instead of skip(), so a page costs the same anywhere in
+# the list and is served straight off an index.
+PAGE_SIZE = int(os.getenv('PAGE_SIZE', '20'))
+
+def seek(fields, key, direction):
+    """Filter for the rows after (direction "n") or before ("p") key in fields order."""
+    op = "$gt" if direction == "n" else "$lt"
+    clauses = []
+    for i, field in enumerate(fields):
+        clause = {f: v for f, v in zip(fields[:i], key[:i])}
+        clause[field] = {op: key[i]}
+        clauses.append(clause)
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+async def fetch_page(collection, filter, projection, fields, direction=None, key=None, computed=None):
+    """One page of collection sorted by fields; returns (docs, has_prev, has_next).
+
+    computed maps extra sort fields to aggregation expressions; those pages
+    are read with an aggregate instead of find().
+    """
+    order = -1 if direction == "p" else 1
+    bounds = seek(fields, key, direction) if direction else {}
+    sort = [(f, order) for f in fields]
+    if computed:
+        pipeline = [{"$match": filter}, {"$addFields": computed}, {"$match": bounds},
+                    {"$sort": dict(sort)}, {"$limit": PAGE_SIZE + 1}, {"$project": projection}]
+        docs = await collection.aggregate(pipeline).to_list(length=None)
+    else:
+        if direction:
+            filter = {"$and": [filter, bounds]}
+        docs = await collection.find(filter, projection).sort(sort).limit(PAGE_SIZE + 1).to_list(length=None)
+    more = len(docs) > PAGE_SIZE
+    docs = docs[:PAGE_SIZE]
+    if direction == "p":
+        docs.reverse()
+        return docs, more, True
+    return docs, direction == "n", more
+
+def page_buttons(prefix, first_key, last_key, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"{prefix}|p|{first_key}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"{prefix}|n|{last_key}"))
+    return buttons
+
+# Dates are free text and may be missing or null; those sort first as "" so
+# every event has a comparable seek key. This sort is computed, not indexed;
+# the events collection is small.
+SORT_DATE = {"$ifNull": ["$date", ""]}
+
+def sort_date(date):
+    return "" if date is None else date
+
 async def admin_list_events_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    events = list(events_col.find().sort("date", 1))
+    direction, key = None, None
+    if query.data.startswith("admin_events|"):
+        # admin_events|<n|p>|<event_id> (older buttons also carry the date before the id).
+        # Only the id fits the 64-byte callback_data limit; its date is looked up here.
+        parts = query.data.split("|")
+        event_id = int(parts[-1])
+        anchor = await events_col.find_one({"event_id": event_id}, {"_id": 0, "date": 1})
+        if anchor is None:
+            await query.edit_message_text("Event not found.")
+            return
+        direction, key = parts[1], (sort_date(anchor.get("date")), event_id)
+    events, has_prev, has_next = await fetch_page(events_col, {}, LISTING_FIELDS, ("sort_date", "event_id"),
+                                                  direction, key, computed={"sort_date": SORT_DATE})
     if not events:
         await query.message.reply_text("No events available.")
         return
     buttons = [
         [InlineKeyboardButton(
-            f"{ev['date']} - {ev['location']}",
+            f"{ev.get('date') or 'no date'} - {ev.get('location', '')}",
             callback_data=f"admin_view_regs_{ev['event_id']}"
         )]
         for ev in events
     ]
-    await query.message.reply_text("Select event to view registrations:", reply_markup=InlineKeyboardMarkup(buttons))
+    pager = page_buttons("admin_events", events[0]['event_id'], events[-1]['event_id'], has_prev, has_next)
+    if pager:
+        buttons.append(pager)
+    if direction:
+        await query.edit_message_text("Select event to view registrations:", reply_markup=InlineKeyboardMarkup(buttons))
+    else:
+        await query.message.reply_text("Select event to view registrations:", reply_markup=InlineKeyboardMarkup(buttons))
 
 # --- Admin: View Registrations for Event ---
 async def admin_view_regs(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    event_id = int(query.data.split("_")[-1])
-    regs = list(registrations_col.find({"event_id": event_id}))
+    direction, key = None, None
+    if query.data.startswith("admin_regs|"):
+        # admin_regs|<event_id>|<n|p>|<last _id>
+        _, event_id, direction, oid = query.data.split("|")
+        event_id, key = int(event_id), (ObjectId(oid),)
+    else:
+        event_id = int(query.data.split("_")[-1])
+    # Registration order is _id order, walked on the (event_id, _id) index
+    regs, has_prev, has_next = await fetch_page(registrations_col, {"event_id": event_id}, {"user_id": 1},
+                                                ("_id",), direction, key)
     if not regs:
         await query.edit_message_text("No registrations for this event.")
         return
     user_ids = [r["user_id"] for r in regs]
-    users = list(users_col.find({"user_id": {"$in": user_ids}}))
+    users = await users_col.find({"user_id": {"$in": user_ids}},
+                                 {"_id": 0, "user_id": 1, "screen_name": 1, "car": 1, "drives": 1}).to_list(length=None)
     user_map = {u["user_id"]: u for u in users}
     text = f"Registrations for Event #{event_id}:\n"
     for r in regs:
         u = user_map.get(r["user_id"])
         if u:
             text += f"\n👤 {u['screen_name']} - 🚗 {u['car']} - 🛣️ {u['drives']} drives"
-    await query.edit_message_text(text)
+    pager = page_buttons(f"admin_regs|{event_id}", regs[0]["_id"], regs[-1]["_id"], has_prev, has_next)
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([pager]) if pager else None)
 
 # --- User: List Upcoming Events ---
-async def user_list_upcoming(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    events = list(events_col.find({
-        "published": True,
-        "date": {"$gte": today}
-    }).sort("date", 1))
+async def render_upcoming(today):
+    events = await repo.list_events(since=today, published_only=True, fields=("date", "location"))
     if not events:
-        await query.edit_message_text("No upcoming events.")
-        return
+        return "No upcoming events.", None
     buttons = [
         [InlineKeyboardButton(
             f"{ev['date']} - {ev['location']}",
@@ -229,26 +328,45 @@ async def user_list_upcoming(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )]
         for ev in events
     ]
-    await query.edit_message_text("Upcoming Events:", reply_markup=InlineKeyboardMarkup(buttons))
+    return "Upcoming Events:", InlineKeyboardMarkup(buttons)
 
-# --- User: Event Detail and Registration ---
-async def user_event_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def user_list_upcoming(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    event_id = int(query.data.split("_")[-1])
-    event = events_col.find_one({"event_id": event_id})
+    # Same for every user; keyed by date so the menu rolls over at midnight (UTC)
+    today = datetime.utcnow().strftime("%Y-%m-%d")
+    text, markup = await views.get(("upcoming", today), lambda: render_upcoming(today))
+    await query.edit_message_text(text, reply_markup=markup)
+
+# --- User: Event Detail and Registration ---
+async def render_event_detail(event_id):
+    # Shared part of the screen plus who is registered; the status line and
+    # button are the per-user overlay applied in user_event_detail
+    event = await repo.get_event(event_id)
     if not event:
-        await query.edit_message_text("Event not found.")
-        return
-    user_id = query.from_user.id
-    is_registered = registrations_col.find_one({"event_id": event_id, "user_id": user_id}) is not None
+        return None
     text = (
         f"Event #{event_id}\n"
         f"Date: {event['date']}\n"
         f"Location: {event['location']}\n"
         f"Min Level: {event['min_level']}\n"
-        f"Status: {'✅ Registered' if is_registered else '❌ Not Registered'}"
     )
+    # Answered from the (event_id, user_id) index alone
+    registered = frozenset(await registrations_col.distinct("user_id", {"event_id": event_id}))
+    return text, registered
+
+async def user_event_detail(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    event_id = int(query.data.split("_")[-1])
+    view = await views.get(("event", event_id), lambda: render_event_detail(event_id))
+    if view is None:
+        views.invalidate(("event", event_id))  # don't keep "not found" around
+        await query.edit_message_text("Event not found.")
+        return
+    text, registered = view
+    is_registered = query.from_user.id in registered
+    text += f"Status: {'✅ Registered' if is_registered else '❌ Not Registered'}"
     await query.edit_message_text(
         text,
         reply_markup=event_registration_buttons(event_id, is_registered)
@@ -261,24 +379,21 @@ async def user_toggle_registration(update: Update, context: ContextTypes.DEFAULT
     event_id = int(query.data.split("_")[-1])
     user_id = query.from_user.id
 
-    # Check profile exists
-    if not users_col.find_one({"user_id": user_id}):
+    # Check profile exists (usually answered from the repository's profile cache)
+    if not await has_profile(user_id):
         await query.message.reply_text("Please create a profile first using /start")
         return
 
-    reg = registrations_col.find_one({"event_id": event_id, "user_id": user_id})
-    if reg:
-        registrations_col.delete_one({"_id": reg["_id"]})
+    # A delete that matches means the user was registered; otherwise register
+    # (an upsert, so a double tap can never insert twice)
+    if await repo.remove_registration(event_id, user_id):
         action = "unregistered"
         is_registered = False
     else:
-        registrations_col.insert_one({
-            "event_id": event_id,
-            "user_id": user_id,
-            "registered_at": datetime.utcnow()
-        })
+        await repo.add_registration(event_id, user_id)
         action = "registered"
         is_registered = True
+    views.invalidate(("event", event_id))
 
     await query.edit_message_text(
         f"You have been {action} for event #{event_id}.",
@@ -291,16 +406,16 @@ async def user_my_registrations(update: Update, context: ContextTypes.DEFAULT_TY
     await query.answer()
     user_id = query.from_user.id
     today = datetime.utcnow().strftime("%Y-%m-%d")
-    regs = list(registrations_col.find({"user_id": user_id}))
+    regs = await registrations_col.find({"user_id": user_id}, {"_id": 0, "event_id": 1}).to_list(length=None)
     if not regs:
         await query.edit_message_text("You have no upcoming registrations.")
         return
     event_ids = [r["event_id"] for r in regs]
-    events = list(events_col.find({
+    events = await events_col.find({
         "event_id": {"$in": event_ids},
         "published": True,
         "date": {"$gte": today}
-    }).sort("date", 1))
+    }, LISTING_FIELDS).sort("date", 1).to_list(length=None)
     if not events:
         await query.edit_message_text("You have no upcoming registrations.")
         return
@@ -319,10 +434,37 @@ async def start_event(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Usage: /start_event <event_id>")
         return
     event_id = int(args[0])
-    regs = registrations_col.find({"event_id": event_id})
-    for reg in regs:
-        users_col.update_one({"user_id": reg["user_id"]}, {"$inc": {"drives": 1}})
-    await update.message.reply_text("Event started and drive counts updated.")
+    # Flag the event first so running /start_event again cannot double-count;
+    # the flag is cleared again if counting fails
+    marked = await events_col.update_one(
+        {"event_id": event_id, "started": {"$ne": True}},
+        {"$set": {"started": True, "started_at": datetime.utcnow()}}
+    )
+    if not marked.matched_count:
+        if await events_col.count_documents({"event_id": event_id}, limit=1):
+            await update.message.reply_text("Event was already started; drive counts were not changed.")
+        else:
+            await update.message.reply_text("Event not found.")
+        return
+    views.invalidate(("event", event_id))
+    try:
+        user_ids = await registrations_col.distinct("user_id", {"event_id": event_id})
+        result = await users_col.update_many({"user_id": {"$in": user_ids}}, {"$inc": {"drives": 1}})
+    except Exception:
+        # Release the marker so the admin can retry instead of being told it already started
+        await events_col.update_one({"event_id": event_id}, {"$unset": {"started": "", "started_at": ""}})
+        raise
+    # Both writes bypass the repository; bump the versions so cached copies are dropped
+    await repo.touch(EVENTS)
+    await repo.touch(PROFILES)
+    await update.message.reply_text(f"Event started and drive counts updated for {result.modified_count} participant(s).")
+
+# --- Admin: Slowest MongoDB commands since start-up ---
+async def show_slowlog(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update, context):
+        await update.message.reply_text("Only admins can view the slow query log.")
+        return
+    await update.message.reply_text(slowlog.summary())
 
 # --- Conversation Handlers for Profile and Event Creation ---
 profile_conv = ConversationHandler(
@@ -350,8 +492,8 @@ admin_event_conv = ConversationHandler(
 )
 
 # --- Main ---
-def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_app():
+    app = runner.builder(BOT_TOKEN).post_init(on_startup).build()
     
     app.add_handler(profile_conv)
     app.add_handler(admin_event_conv)
@@ -359,16 +501,23 @@ def main():
     app.add_handler(CommandHandler("admin", show_admin_menu))
     app.add_handler(CommandHandler("menu", show_user_menu))
     app.add_handler(CommandHandler("start_event", start_event))
+    app.add_handler(CommandHandler("slowlog", show_slowlog))
 
     app.add_handler(CallbackQueryHandler(admin_list_events_entry, pattern="^admin_list_events$"))
+    app.add_handler(CallbackQueryHandler(admin_list_events_entry, pattern="^admin_events\\|"))
     app.add_handler(CallbackQueryHandler(admin_view_regs, pattern="^admin_view_regs_"))
+    app.add_handler(CallbackQueryHandler(admin_view_regs, pattern="^admin_regs\\|"))
     app.add_handler(CallbackQueryHandler(user_list_upcoming, pattern="^user_list_upcoming$"))
     app.add_handler(CallbackQueryHandler(user_event_detail, pattern="^user_event_detail_"))
     app.add_handler(CallbackQueryHandler(user_toggle_registration, pattern="^user_toggle_reg_"))
     app.add_handler(CallbackQueryHandler(user_my_registrations, pattern="^user_my_registrations$"))
+    app.add_handler(admin_cache.handler())
+    return app
 
+def main():
+    app = build_app()
     print("Bot running...")
-    app.run_polling()
+    runner.run(app)
 
 if __name__ == "__main__":
     main()
@@ -1,64 +1,68 @@
+import asyncio
 import os, datetime
 from dotenv import load_dotenv
 import json
 from telegram import Update, InputFile,ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, PollAnswerHandler, MessageHandler, filters, ContextTypes
-
-# Load questions from external JSON file
-def load_drives(filename="questions_drive.json"):
-    with open(filename, "r", encoding="utf-8") as f:
-        return json.load(f)
-# Load refence locations from external JSON file
-def load_references(ref):
-    filename=f"questions_{ref}.json"
-    with open(filename, "r", encoding="utf-8") as f:
-        return json.load(f)
+import runner
+from state_store import StateStore
+from questionnaire import QuestionnaireRegistry
+from responses_store import ResponseStore
+from media_cache import MediaCache
+from metrics import metrics
 
 load_dotenv()
 
-QUESTIONS = load_drives()
+# Questions from the questions_*.json files, compiled once and reloaded when a file changes
+questionnaires = QuestionnaireRegistry(os.getenv("QUESTIONS_DIR", "."))
 Q_CONFIRM = { "question": "Publish?", "options": ["Yes", "No"]}
 
-user_states = {}    # user_id -> {"current_q": int, "answers": list, "awaiting_text": bool}
-poll_to_user = {}   # poll_id -> user_id
+# Questionnaire sessions and poll_id -> user_id, persisted so a restart resumes them
+store = StateStore(
+    os.getenv("STATE_DB", "serve3_state.db"),
+    session_ttl=float(os.getenv("SESSION_TTL", "86400")),
+    poll_ttl=float(os.getenv("POLL_TTL", "86400")),
+)
+metrics.add_collector("state_store", store.stats)
+
+# Confirmed questionnaires, appended to rotating JSONL files by a background writer
+responses = ResponseStore(os.getenv("RESPONSES_DIR", "responses"))
+
+# Telegram file_ids of images already uploaded once
+media = MediaCache(os.getenv("MEDIA_CACHE", "media_cache.json"))
 
 async def create_drive(update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_states[user_id] = {"current_q": 0, "answers": [], "awaiting_text": False, "confirmation": False}
-    QUESTIONS = load_drives()
+    store.start(user_id)
     await send_next_poll(context, user_id)
 
 async def send_next_poll(context, user_id):
-    state = user_states[user_id]
-    if state["confirmation"]:
-        return  # Already in confirmation phase
-
-    q_index = state["current_q"]
-    if q_index < len(QUESTIONS):
-        q = QUESTIONS[q_index]
+    state = store.get(user_id)
+    if state is None or state.confirmation:
+        return  # Already in confirmation phase (or the session expired)
+
+    questions = questionnaires.get("drive")
+    q_index = state.current_q
+    if q_index < len(questions):
+        q = questions[q_index]
         # If this is a text-only question
-        if q.get("type") == "text":
-            state["awaiting_text"] = True
+        if q.kind == "text":
+            state.awaiting_text = True
+            store.save(state)
             await context.bot.send_message(
                 chat_id=user_id,
-                text=q["question"]
+                text=q.text
             )
         else:
-            if q.get("reference"):
-                qref = load_references(q.get("reference"))
-                options = qref["options"]
-                if q.get("allow_text"):
-                    options.append("Other")
-            else:
-                options = q["options"]
+            # Options already include referenced lists and the trailing "Other"
             msg = await context.bot.send_poll(
                 chat_id=user_id,
-                question=q["question"],
-                options=options,
+                question=q.text,
+                options=q.options,
                 is_anonymous=False,
                 allows_multiple_answers=False
             )
-            poll_to_user[msg.poll.id] = user_id
+            store.bind_poll(msg.poll.id, user_id)
     else:
         await show_confirmation(context, user_id)
 
@@ -72,79 +76,59 @@ async def send_next_poll(context, user_id):
 async def receive_poll_answer(update, context: ContextTypes.DEFAULT_TYPE):
     poll_answer = update.poll_answer
     poll_id = poll_answer.poll_id
-    user_id = poll_to_user.get(poll_id)
-    if user_id is None or user_id not in user_states:
+    user_id = store.poll_user(poll_id)
+    state = store.get(user_id) if user_id is not None else None
+    if state is None:
         return
-    state = user_states[user_id]
-    q_index = state["current_q"]
-    question = QUESTIONS[q_index]
-    
+    questions = questionnaires.get("drive")
+    if state.current_q >= len(questions):
+        # Late or duplicate answer after the last question (or after a reload shortened the questionnaire)
+        store.drop_poll(poll_id)
+        return
+    question = questions[state.current_q]
+
     answer_index = poll_answer.option_ids[0] if poll_answer.option_ids else None
-    if question.get("allow_text") and question.get("reference"):
-        references = load_references(question.get("reference"))
-        len_answers = len(references["options"]) +1
-    elif question.get("reference"):
-        references = load_references(question.get("reference"))
-        len_answers = len(references["options"])
-    else:
-        len_answers = len(question["options"])
-
-    # Check if this question allows a text answer and if "Other" was selected
-    if (
-       question.get("allow_text") and question.get("reference") and
-       answer_index == len_answers  # Last appended should be "Other", so no -1
-    ):
-        state["awaiting_text"] = True
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Please type your answer:"
-        )
-        # Don't increment current_q yet; wait for text response
-    elif (
-        question.get("allow_text") and
-        answer_index == len_answers - 1  # Last option is "Other"
-    ):
-        state["awaiting_text"] = True
+
+    # Check if this question allows a text answer and if "Other" (always the last option) was selected
+    if answer_index is not None and answer_index == question.other_index:
+        state.awaiting_text = True
+        store.save(state)
         await context.bot.send_message(
             chat_id=user_id,
             text="Please type your answer:"
         )
         # Don't increment current_q yet; wait for text response
-    elif question.get("reference"):
-        # Save the selected answer
-        answer = references["options"][answer_index] if answer_index is not None else "No answer"
-        state["answers"].append(answer)
-        state["current_q"] += 1
-        del poll_to_user[poll_id]
-        await send_next_poll(context, user_id)
     else:
         # Save the selected answer
-        answer = question["options"][answer_index] if answer_index is not None else "No answer"
-        state["answers"].append(answer)
-        state["current_q"] += 1
-        del poll_to_user[poll_id]
+        answer = question.options[answer_index] if answer_index is not None else "No answer"
+        state.answers.append(answer)
+        state.current_q += 1
+        store.save(state)
+        store.drop_poll(poll_id)
         await send_next_poll(context, user_id)
 
 async def receive_text(update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    if user_id not in user_states:
+    state = store.get(user_id)
+    if state is None:
         return  # Ignore messages from users not in survey
-    state = user_states[user_id]
-    if state.get("awaiting_text"):
+    if state.awaiting_text:
         # Save the user's text answer for the current question
-        state["answers"].append(update.message.text)
-        state["current_q"] += 1
-        state["awaiting_text"] = False
+        state.answers.append(update.message.text)
+        state.current_q += 1
+        state.awaiting_text = False
+        store.save(state)
         await send_next_poll(context, user_id)
 
 async def show_confirmation(context, user_id):
     """Show summary and confirmation buttons"""
-    state = user_states[user_id]
-    state["confirmation"] = True
+    state = store.get(user_id)
+    state.confirmation = True
+    store.save(state)
     
     summary = ["📝 *Your Answers:*\n"]
-    for idx, (q, a) in enumerate(zip(QUESTIONS, state["answers"])):
-        summary.append(f"*{q['question']}*\n   ➥ {a}")
+    for idx, (q, a) in enumerate(zip(questionnaires.get("drive"), state.answers)):
+        summary.append(f"*{q.text}*\n   ➥ {a}")
     
     # Add confirmation buttons
     markup = ReplyKeyboardMarkup([["/Confirm ✅", "/Cancel 🚫"]], one_time_keyboard=True)
@@ -159,56 +143,65 @@ async def show_confirmation(context, user_id):
 
 async def handle_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    state = user_states.get(user_id)
+    state = store.get(user_id)
     print("[DEBUG]: in confirmation handler")
-    if not state or not state["confirmation"]:
+    if not state or not state.confirmation:
         print("[DEBUG]: in confirmation handler but wrong state")
         return
     
     choice = update.message.text.lower()
     print(f"[DEBUG]: in {choice}")
     if "confirm" in choice:
-        # Save answers to JSON file
+        # Save answers; resolves once the writer has fsynced the batch holding them
         timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"responses/{user_id}_{timestamp}.json"
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        
-        with open(filename, "w") as f:
-            json.dump({
-                "user_id": user_id,
-                "answers": state["answers"],
-                "timestamp": timestamp
-            }, f)
+        await asyncio.wrap_future(responses.append({
+            "user_id": user_id,
+            "answers": state.answers,
+            "timestamp": timestamp
+        }))
         
         # Send final confirmation image
         IMAGE_DIR =""
         conf_image = os.path.join(IMAGE_DIR, "confirmed.jpg")
         if os.path.exists(conf_image):
-            with open(conf_image, "rb") as photo:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=InputFile(photo),
-                    caption="✅ Answers confirmed and saved!"
-                )
+            await media.send_photo(
+                context.bot,
+                user_id,
+                conf_image,
+                caption="✅ Answers confirmed and saved!"
+            )
         else:
             await update.message.reply_text("✅ Answers confirmed and saved!")
         
-        del user_states[user_id]
+        store.finish(user_id)
     else:
         await update.message.reply_text("Restarting survey...")
         await create_drive(update, context)
 
 
-def main():
+async def on_startup(application):
+    store.start_writer()
+    responses.start()
+    # Pick up the old one-file-per-confirmation responses (no-op after the first run)
+    await asyncio.to_thread(responses.import_legacy)
+
+async def on_shutdown(application):
+    await store.close()
+    await asyncio.to_thread(responses.close)
+
+def build_app():
     bot_token = os.getenv("BOT_TOKEN")
     if not bot_token:
         raise RuntimeError("Please set the BOT_TOKEN environment variable.")
-    application = Application.builder().token(bot_token).build()
+    application = runner.builder(bot_token).post_init(on_startup).post_shutdown(on_shutdown).build()
     application.add_handler(CommandHandler("new_drive", create_drive))
     application.add_handler(PollAnswerHandler(receive_poll_answer))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, receive_text))
     application.add_handler(MessageHandler(filters.Regex(r"Confirm|Restart"), handle_confirmation))
-    application.run_polling()
+    return application
+
+def main():
+    runner.run(build_app())
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,7 @@
 from telegram import Update, BotCommand, BotCommandScopeChat
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
+from admin_cache import admin_cache
+import runner
 
 # Define commands for admins and non-admins
 ADMIN_COMMANDS = [
@@ -22,8 +24,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Get the user's status in the chat
-    member = await context.bot.get_chat_member(chat.id, user.id)
-    is_admin = member.status in ['administrator', 'creator']
+    is_admin = await admin_cache.is_admin(context.bot, chat.id, user.id)
 
     # Set commands based on role
     if is_admin:
@@ -56,9 +57,10 @@ if __name__ == '__main__':
         print("Please set the TELEGRAM_TOKEN environment variable.")
         exit(1)
 
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = runner.builder(TOKEN).build()
 
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(admin_cache.handler())
 
     print("Bot is running...")
-    app.run_polling()
+    runner.run(app)
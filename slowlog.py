@@ -0,0 +1,162 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import RotatingFileHandler
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# MongoDB commands explain() accepts; the rest (insert, getMore, ...) are logged without a plan
+EXPLAINABLE = {"find", "aggregate", "count", "distinct", "update", "delete", "findAndModify"}
+# Session and routing fields the server adds to a command; explain rejects them
+COMMAND_NOISE = {"lsid", "txnNumber", "autocommit", "startTransaction", "signature"}
+
+
+def redact(value):
+    """Keep the shape of parameters or a command document, replace every value with its type."""
+    if isinstance(value, dict):
+        return {k: redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value[:5]] + (["..."] if len(value) > 5 else [])
+    if value is None:
+        return None
+    return f"?{type(value).__name__}"
+
+
+def _plan_summary(plan):
+    # {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": ...}} -> "FETCH <- IXSCAN(event_user_unique)"
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        inputs = plan.get("inputStages")
+        plan = plan.get("inputStage") or (inputs[0] if inputs else None)
+    return " <- ".join(stages)
+
+
+class SlowLog:
+    """Statements and commands slower than threshold_ms, with their query plans.
+
+    Every offender is written as one JSON line (statement, redacted
+    parameters, duration, plan) to a size-rotated file and counted in an
+    in-memory summary for the /slowlog admin command. SQLite plans come from
+    EXPLAIN QUERY PLAN on the same connection; MongoDB plans from the explain
+    command, run on a background thread. A statement is explained at most
+    once per plan_interval seconds.
+    """
+
+    def __init__(self, path="slowlog.jsonl", threshold_ms=200.0, max_bytes=5 * 1024 * 1024, backups=3,
+                 plan_interval=60.0, max_statements=500):
+        self.threshold = threshold_ms / 1000.0
+        self.plan_interval = plan_interval
+        self.max_statements = max_statements
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._logger = None
+        self._lock = threading.Lock()
+        self._summary = {}  # (backend, statement) -> [count, total_seconds, max_seconds, plan, explained_at]
+        self._explainer = None
+
+    @property
+    def _records(self):
+        # Opened on the first slow statement, so quiet bots never create the file
+        if self._logger is None:
+            self._logger = logging.getLogger("slowlog.records")
+            self._logger.propagate = False
+            handler = RotatingFileHandler(self._path, maxBytes=self._max_bytes, backupCount=self._backups,
+                                          encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(handler)
+            self._logger.setLevel(logging.INFO)
+        return self._logger
+
+    def _needs_plan(self, key):
+        with self._lock:
+            entry = self._summary.get(key)
+            return entry is None or time.monotonic() - entry[4] >= self.plan_interval
+
+    def record(self, backend, statement, params, seconds, plan=None):
+        key = (backend, statement)
+        with self._lock:
+            entry = self._summary.get(key)
+            if entry is None:
+                if len(self._summary) >= self.max_statements:
+                    # Forget the statement with the least total time
+                    del self._summary[min(self._summary, key=lambda k: self._summary[k][1])]
+                entry = self._summary[key] = [0, 0.0, 0.0, None, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            if plan is not None:
+                entry[3], entry[4] = plan, time.monotonic()
+        self._records.info(json.dumps({
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "backend": backend, "ms": round(seconds * 1000, 1),
+            "statement": statement, "params": params, "plan": plan,
+        }, default=str, ensure_ascii=False))
+
+    # --- SQLite ---
+
+    def sqlite(self, conn, sql, params, seconds, many=False):
+        """Record a slow statement; called on the connection's thread right after it ran."""
+        statement = re.sub(r"\s+", " ", sql).strip()
+        plan = None
+        if self._needs_plan(("sqlite", statement)):
+            try:
+                explain_params = (params[0] if params else ()) if many else params
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", explain_params).fetchall()
+                plan = "; ".join(row[-1] for row in rows)
+            except Exception as e:
+                plan = f"unavailable: {e}"
+        self.record("sqlite", statement, f"{len(params)} rows" if many else redact(params), seconds, plan)
+
+    # --- MongoDB ---
+
+    def mongo(self, client, database, command_name, command, seconds):
+        """Record a slow command; the explain runs on a worker thread, never on the driver's."""
+        collection = command.get(command_name)
+        body = {k: v for k, v in command.items() if not k.startswith("$") and k not in COMMAND_NOISE}
+        shape = redact({k: v for k, v in body.items() if k != command_name})
+        statement = f"{database}.{collection} {command_name} {json.dumps(shape, sort_keys=True, default=str)}"
+        if client is None or command_name not in EXPLAINABLE or not self._needs_plan(("mongo", statement)):
+            self.record("mongo", statement, shape, seconds)
+            return
+        if self._explainer is None:
+            self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="slowlog-explain")
+        self._explainer.submit(self._explain, client, database, body, statement, shape, seconds)
+
+    def _explain(self, client, database, body, statement, shape, seconds):
+        try:
+            result = client[database].command({"explain": body, "verbosity": "queryPlanner"})
+            plan = _plan_summary(result.get("queryPlanner", {}).get("winningPlan"))
+        except Exception as e:
+            plan = f"unavailable: {e}"
+        self.record("mongo", statement, shape, seconds, plan)
+
+    # --- Summary ---
+
+    def stats(self):
+        with self._lock:
+            return {"statements": len(self._summary), "offenders": sum(e[0] for e in self._summary.values())}
+
+    def summary(self, limit=10):
+        """Slowest statements since start-up by total time, as text for the /slowlog command."""
+        with self._lock:
+            entries = sorted(self._summary.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        if not entries:
+            return f"No statements slower than {self.threshold * 1000:.0f} ms since start-up."
+        lines = [f"Slowest statements (> {self.threshold * 1000:.0f} ms) since start-up:"]
+        for (backend, statement), (count, total, longest, plan, _) in entries:
+            lines.append(f"\n{count}× max {longest * 1000:.0f} ms, total {total * 1000:.0f} ms [{backend}]\n"
+                         f"{statement[:300]}\nplan: {plan or '-'}")
+        return "\n".join(lines)[:4000]
+
+
+slowlog = SlowLog(os.getenv("SLOWLOG_FILE", "slowlog.jsonl"), threshold_ms=float(os.getenv("SLOWLOG_MS", "200")))
+metrics.add_collector("slowlog", slowlog.stats)
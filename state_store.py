@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Session:
+    """Progress of one user through the drive questionnaire."""
+
+    __slots__ = ("user_id", "current_q", "answers", "awaiting_text", "confirmation", "touched")
+
+    def __init__(self, user_id, current_q=0, answers=None, awaiting_text=False, confirmation=False, touched=None):
+        self.user_id = user_id
+        self.current_q = current_q
+        self.answers = answers if answers is not None else []
+        self.awaiting_text = awaiting_text
+        self.confirmation = confirmation
+        self.touched = touched if touched is not None else time.time()
+
+    def row(self):
+        return (self.user_id, self.current_q, json.dumps(self.answers, ensure_ascii=False),
+                int(self.awaiting_text), int(self.confirmation), self.touched)
+
+
+class StateStore:
+    """Questionnaire sessions and poll_id -> user_id mapping.
+
+    Lives in memory for the handlers, evicts sessions idle for longer than
+    session_ttl (and polls nobody answered within poll_ttl), and writes changes
+    behind to a SQLite file every flush_interval seconds so a restarted bot
+    picks up questionnaires where they were left.
+    """
+
+    def __init__(self, path, session_ttl=86400.0, poll_ttl=86400.0, flush_interval=2.0):
+        self.session_ttl = session_ttl
+        self.poll_ttl = poll_ttl
+        self.flush_interval = flush_interval
+        self._sessions = {}   # user_id -> Session
+        self._polls = {}      # poll_id -> (user_id, created)
+        self._dirty_sessions = set()
+        self._dirty_polls = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn_lock = threading.Lock()
+        self._flush_lock = asyncio.Lock()
+        self._writer = None
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                                    user_id INTEGER PRIMARY KEY, current_q INTEGER, answers TEXT,
+                                    awaiting_text INTEGER, confirmation INTEGER, touched REAL)''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS polls (
+                                    poll_id TEXT PRIMARY KEY, user_id INTEGER, created REAL)''')
+        self._load()
+
+    def _load(self):
+        for user_id, current_q, answers, awaiting_text, confirmation, touched in self._conn.execute(
+                "SELECT user_id, current_q, answers, awaiting_text, confirmation, touched FROM sessions"):
+            self._sessions[user_id] = Session(user_id, current_q, json.loads(answers),
+                                              bool(awaiting_text), bool(confirmation), touched)
+        for poll_id, user_id, created in self._conn.execute("SELECT poll_id, user_id, created FROM polls"):
+            self._polls[poll_id] = (user_id, created)
+        self.sweep()
+        logger.info("Restored %d questionnaire session(s) and %d open poll(s)", len(self._sessions), len(self._polls))
+
+    # --- Sessions ---
+
+    def start(self, user_id):
+        session = self._sessions[user_id] = Session(user_id)
+        self._dirty_sessions.add(user_id)
+        return session
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session and time.time() - session.touched > self.session_ttl:
+            self.finish(user_id)
+            return None
+        return session
+
+    def save(self, session):
+        """Record that session changed; it is written out on the next flush."""
+        session.touched = time.time()
+        self._dirty_sessions.add(session.user_id)
+
+    def finish(self, user_id):
+        self._sessions.pop(user_id, None)
+        self._dirty_sessions.add(user_id)
+        for poll_id in [p for p, (uid, _) in self._polls.items() if uid == user_id]:
+            self.drop_poll(poll_id)
+
+    # --- Polls ---
+
+    def bind_poll(self, poll_id, user_id):
+        self._polls[poll_id] = (user_id, time.time())
+        self._dirty_polls.add(poll_id)
+
+    def poll_user(self, poll_id):
+        entry = self._polls.get(poll_id)
+        return entry[0] if entry else None
+
+    def drop_poll(self, poll_id):
+        self._polls.pop(poll_id, None)
+        self._dirty_polls.add(poll_id)
+
+    # --- Eviction and persistence ---
+
+    def sweep(self):
+        now = time.time()
+        for user_id in [u for u, s in self._sessions.items() if now - s.touched > self.session_ttl]:
+            self.finish(user_id)
+        for poll_id in [p for p, (uid, created) in self._polls.items()
+                        if uid not in self._sessions or now - created > self.poll_ttl]:
+            self.drop_poll(poll_id)
+
+    def stats(self):
+        return {"sessions": len(self._sessions), "polls": len(self._polls),
+                "pending_writes": len(self._dirty_sessions) + len(self._dirty_polls)}
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty_sessions and not self._dirty_polls:
+                return
+            # Snapshot on the loop thread; the SQLite write happens off it
+            upserts, deletes = [], []
+            for user_id in self._dirty_sessions:
+                session = self._sessions.get(user_id)
+                if session:
+                    upserts.append(session.row())
+                else:
+                    deletes.append((user_id,))
+            poll_upserts, poll_deletes = [], []
+            for poll_id in self._dirty_polls:
+                entry = self._polls.get(poll_id)
+                if entry:
+                    poll_upserts.append((poll_id, *entry))
+                else:
+                    poll_deletes.append((poll_id,))
+            dirty_sessions, self._dirty_sessions = self._dirty_sessions, set()
+            dirty_polls, self._dirty_polls = self._dirty_polls, set()
+            try:
+                await asyncio.to_thread(self._write, upserts, deletes, poll_upserts, poll_deletes)
+            except Exception:
+                # Keep the changes queued for the next attempt
+                self._dirty_sessions |= dirty_sessions
+                self._dirty_polls |= dirty_polls
+                raise
+
+    def _write(self, upserts, deletes, poll_upserts, poll_deletes):
+        with self._conn_lock, self._conn:
+            self._conn.executemany("REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)", upserts)
+            self._conn.executemany("DELETE FROM sessions WHERE user_id = ?", deletes)
+            self._conn.executemany("REPLACE INTO polls VALUES (?, ?, ?)", poll_upserts)
+            self._conn.executemany("DELETE FROM polls WHERE poll_id = ?", poll_deletes)
+
+    async def _write_behind(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.sweep()
+                await self.flush()
+            except Exception:
+                logger.exception("Writing questionnaire state failed")
+
+    def start_writer(self):
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_behind())
+
+    async def close(self):
+        if self._writer:
+            self._writer.cancel()
+            self._writer = None
+        await self.flush()
+        with self._conn_lock:
+            self._conn.close()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import metrics
+from slowlog import redact, slowlog
+
+logger = logging.getLogger(__name__)
+
+
+class Database:
+    """Small pool of SQLite connections, each pinned to its own worker thread.
+
+    Handlers await the helpers below; the blocking sqlite3 call runs on the
+    connection's thread so a slow COMMIT never stalls the event loop, and
+    every call gets a connection (and cursor) of its own.
+    """
+
+    def __init__(self, path, pool_size=4, busy_timeout=5.0):
+        self.path = path
+        # Every ":memory:" connection would be a separate empty database.
+        if path == ":memory:":
+            pool_size = 1
+        self._workers = []
+        for i in range(pool_size):
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"sqlite-{i}")
+            conn = executor.submit(self._connect, path, busy_timeout).result()
+            self._workers.append((conn, executor))
+        self._idle = None
+        logger.debug("Opened %d connection(s) to %s", pool_size, path)
+
+    @staticmethod
+    def _connect(path, busy_timeout):
+        conn = sqlite3.connect(path, timeout=busy_timeout, uri=path.startswith("file:"))
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _pool(self):
+        # Created lazily so the queue binds to the loop the bot actually runs on.
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+        return self._idle
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on a pooled connection's thread and return its result."""
+        pool = self._pool()
+        # Timed from the request, so waiting for a free connection shows up too
+        with metrics.track("db", ("sqlite", fn.__name__.lstrip("_"))):
+            lease = None
+            args = (fn, *args)
+            fn = _timed if fn in _STATEMENTS else _timed_call
+            try:
+                # Leased inside the try, so a cancellation right after get() still returns it
+                lease = await pool.get()
+                conn, executor = lease
+                return await asyncio.get_running_loop().run_in_executor(executor, fn, conn, *args)
+            finally:
+                if lease is not None:
+                    pool.put_nowait(lease)
+
+    def run_sync(self, fn, *args):
+        """Blocking variant of run() for startup code outside the event loop."""
+        conn, executor = self._workers[0]
+        return executor.submit(fn, conn, *args).result()
+
+    async def execute(self, sql, params=()):
+        """Execute a write statement and commit; returns (rowcount, lastrowid)."""
+        return await self.run(_execute, sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.run(_executemany, sql, seq_of_params)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(_fetchone, sql, params)
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(_fetchall, sql, params)
+
+    def close(self):
+        for conn, executor in self._workers:
+            executor.submit(conn.close).result()
+            executor.shutdown()
+        self._workers = []
+
+
+def _execute(conn, sql, params):
+    with conn:
+        cur = conn.execute(sql, params)
+    return cur.rowcount, cur.lastrowid
+
+
+def _executemany(conn, sql, seq_of_params):
+    with conn:
+        cur = conn.executemany(sql, seq_of_params)
+    return cur.rowcount
+
+
+def _fetchone(conn, sql, params):
+    return conn.execute(sql, params).fetchone()
+
+
+def _fetchall(conn, sql, params):
+    return conn.execute(sql, params).fetchall()
+
+
+_STATEMENTS = {_execute, _executemany, _fetchone, _fetchall}
+
+
+def _timed(conn, fn, sql, params):
+    # sqlite3's trace callback reports statements but not durations, so they are timed here
+    started = time.perf_counter()
+    result = fn(conn, sql, params)
+    elapsed = time.perf_counter() - started
+    if elapsed >= slowlog.threshold:
+        slowlog.sqlite(conn, sql, params, elapsed, many=fn is _executemany)
+    return result
+
+
+def _timed_call(conn, fn, *args):
+    # Callables that run several statements (e.g. repository writes) are logged
+    # under their name, since there is no single statement to explain
+    started = time.perf_counter()
+    result = fn(conn, *args)
+    elapsed = time.perf_counter() - started
+    if elapsed >= slowlog.threshold:
+        slowlog.record("sqlite", f"{fn.__module__}.{fn.__qualname__}", redact(args), elapsed)
+    return result
@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import time
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class _KeyState:
+    __slots__ = ("lock", "depth", "last_wait")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+        self.last_wait = 0.0
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently, but strictly in order per user (or chat).
+
+    Step-based flows (user_data["step"], ConversationHandler states) only ever
+    see one update at a time for a given user, while different users run in
+    parallel up to max_concurrent_updates. An update waits for its key before
+    it takes a worker slot, so a user with a backlog cannot starve the others.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._keys = {}
+        self.processed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def key_for(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return ("user", update.effective_user.id)
+        if update.effective_chat:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def process_update(self, update, coroutine):
+        key = self.key_for(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState()
+        state.depth += 1
+        queued_at = time.monotonic()
+        try:
+            # asyncio.Lock hands over in FIFO order, which preserves arrival order
+            async with state.lock:
+                wait = time.monotonic() - queued_at
+                state.last_wait = wait
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                await super().process_update(update, coroutine)
+        finally:
+            self.processed += 1
+            state.depth -= 1
+            if not state.depth:
+                del self._keys[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        """Current queue depth and last wait per active key, plus overall wait times."""
+        return {
+            "max_concurrent_updates": self.max_concurrent_updates,
+            "processed": self.processed,
+            "avg_wait": self.total_wait / self.processed if self.processed else 0.0,
+            "max_wait": self.max_wait,
+            "keys": {f"{kind}:{ident}": {"depth": s.depth, "last_wait": s.last_wait}
+                     for (kind, ident), s in self._keys.items()},
+        }
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ViewCache:
+    """Rendered bot screens shared by every user, keyed by (view, ...) tuples.
+
+    get() returns the cached value or awaits render() to build it; concurrent
+    misses on one key share a single render. Handlers that change the data
+    behind a view drop it with invalidate() or invalidate_view(), so the TTL
+    only bounds staleness for writes made outside this process. Anything
+    user-specific is applied by the caller on top of the shared value.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}   # key -> (value, expires_at)
+        self._inflight = {}  # key -> Task
+        self._generation = 0
+
+    async def get(self, key, render):
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        self.misses += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render(key, render, self._generation))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.get(key) is t and self._inflight.pop(key))
+        return await asyncio.shield(task)
+
+    async def _render(self, key, render, generation):
+        value = await render()
+        # An invalidation while rendering means value may predate the change: serve it once, don't keep it
+        if generation == self._generation:
+            self._prune()
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+        return value
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [k for k, (_, expires) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+    def invalidate(self, key):
+        self._generation += 1
+        self._inflight.pop(key, None)  # later callers must not join a render that started before the change
+        if self._entries.pop(key, None) is not None:
+            logger.debug("Invalidated view %s", key)
+
+    def invalidate_view(self, view):
+        """Drop every entry of one view, whatever the rest of its key (e.g. all dates)."""
+        self._generation += 1
+        for key in [k for k in self._entries if k[0] == view]:
+            del self._entries[key]
+        for key in [k for k in self._inflight if k[0] == view]:
+            del self._inflight[key]
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+        self._inflight.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}